@@ -6,11 +6,12 @@ from datetime import datetime, timezone
 import argparse
 import sys
 import csv
+import json
 
 # App custom modules
 from tasktracker import taskdb
 
-APP_VER = "2.03"
+APP_VER = "2.04"
 logger = logging.getLogger("TaskTracker")
 
 with open("log.conf", 'rt') as f:
@@ -100,15 +101,15 @@ def deleteTask(dbConn, taskName):
     return
 
 
-def editTask(dbConn, orgTaskName, newTaskName=None, newTaskDesc=None):
-    """Editing a task"""
+def editTask(dbConn, orgTaskName, newTaskName=None, newTaskDesc=None, newParent=None):
+    """Editing a task. newParent '' makes it a top level task"""
     # Validation:
     if newTaskName == '' or newTaskName == "''":
         msg = "Invalid request: Please do not try to clear the task name."
         logger.info(msg)
         print(msg)
         return
-    elif newTaskName == None and newTaskDesc == None:
+    elif newTaskName == None and newTaskDesc == None and newParent == None:
         msg = "Invalid request: Not sure what you want to change?"
         logger.info(msg)
         print(msg)
@@ -123,17 +124,60 @@ def editTask(dbConn, orgTaskName, newTaskName=None, newTaskDesc=None):
         print(msg)
         return
 
+    # Get the taskID for the parent task name
+    parentID = None
+    if newParent != None and newParent != '' and newParent != "''":
+        parentInfo = taskdb.getTaskID(dbConn, newParent)
+        logger.debug(f"parentInfo = {parentInfo}")
+        if parentInfo == None:  # No task found
+            msg = f"Parent '{newParent}' not found"
+            logger.info(msg)
+            print(msg)
+            return
+        parentID = parentInfo[0]
+
     # Getter done
-    result = taskdb.changeTask(
-        dbConn, taskID=taskInfo[0], newName=newTaskName, newDesc=newTaskDesc)
-    if result:
-        msg = "Task Update"
-    else:
-        msg = f"'{orgTaskName}' not update. Task name already exists"
+    if newTaskName != None or newTaskDesc != None:
+        result = taskdb.changeTask(
+            dbConn, taskID=taskInfo[0], newName=newTaskName, newDesc=newTaskDesc)
+        if result:
+            msg = "Task Update"
+        else:
+            msg = f"'{orgTaskName}' not update. Task name already exists"
+        logger.info(msg)
+        print(msg)
+
+    if newParent != None:
+        if taskdb.setTaskParent(dbConn, taskID=taskInfo[0], parentID=parentID):
+            msg = "Task parent update"
+        else:
+            msg = f"'{orgTaskName}' parent not update. '{newParent}' is '{orgTaskName}' or one of its sub tasks"
+        logger.info(msg)
+        print(msg)
+    return
+
 
+def tagTask(dbConn, taskName, tagName, remove=False):
+    """Add or remove a tag on a task"""
+    taskInfo = taskdb.getTaskID(dbConn, taskName)
+    logger.debug(f"taskInfo = {taskInfo}")
+    if taskInfo == None:  # No task found
+        msg = f"'{taskName}' not found"
+        logger.info(msg)
+        print(msg)
+        return
+
+    result = taskdb.tagTask(dbConn, taskInfo[0], tagName, remove=remove)
+    if remove and result:
+        msg = f"Tag '{tagName}' removed from task '{taskInfo[1]}'"
+    elif remove:
+        msg = f"Task '{taskInfo[1]}' does not have tag '{tagName}'"
+    elif result:
+        msg = f"Tag '{tagName}' added to task '{taskInfo[1]}'"
+    else:
+        msg = f"Task '{taskInfo[1]}' already has tag '{tagName}'"
     logger.info(msg)
     print(msg)
-    return
 
 
 def deactivateTasks(dbConn, utc_dt, silent=False):
@@ -144,47 +188,90 @@ def deactivateTasks(dbConn, utc_dt, silent=False):
     utc_dt : UTC time value for endtime on active task(s)
     silent : True - no report of tasks not found. False - report if tasks not found
     """
-    activeTask = taskdb.getActiveTask(dbConn)
-    if len(activeTask) == 0:  # no Active task
+    endedTasks = taskdb.endActiveTasks(dbConn, utc_dt)
+    _printEnded(endedTasks, utc_dt, silent=silent)
+    logger.debug("End track on active tasks complete")
+
+
+def _printEnded(endedTasks, utc_dt, silent=False):
+    """Display the task(s) tracking was ended on
+
+    PARM:
+    endedTasks : list (TaskID, TaskName, Tracking_id)
+    utc_dt : UTC time value tracking was ended
+    silent : True - no report of tasks not found. False - report if tasks not found
+    """
+    if len(endedTasks) == 0:  # no Active task
         logger.info(f"No task active")
         if not silent:
             print("No active tasks found to end tracking on")
     else:
-        for aTask in activeTask:
-            aTaskID = aTask[0]
-            aTaskName = aTask[1]
-            aTrackID = aTask[2]
+        localNow = utc_to_local(utc_dt)
+        for aTask in endedTasks:
             logger.info(
-                f"Deactivate TaskID: {aTaskID} TaskName: '{aTaskName}' TrackID: {aTrackID}")
-            taskdb.setTaskTrack(dbConn, aTaskID, utc_dt, trackID=aTrackID)
-            localNow = utc_to_local(utc_dt)
+                f"Deactivated TaskID: {aTask[0]} TaskName: '{aTask[1]}' TrackID: {aTask[2]}")
             print(
-                f"'{aTaskName}' tracking ended {localNow.strftime('%Y-%m-%d %H:%M:%S %z')}")
-    logger.debug("End track on active tasks complete")
+                f"'{aTask[1]}' tracking ended {localNow.strftime('%Y-%m-%d %H:%M:%S %z')}")
 
 
 def trackTask(dbConn, taskName):
     """Start time track for task name, and end tracking on active task."""
     # What is current utc time
     utcNow = local_to_utc(datetime.now())
-    localNow = utc_to_local(utcNow)
 
-    # end tracking on active task(s)
-    deactivateTasks(dbConn, utcNow, silent=True)
     # Does the task exist?
     taskRows = taskdb.getTaskID(dbConn, taskName)
     if taskRows:
         taskID = taskRows[0]
-        taskdb.setTaskTrack(dbConn, taskID, utcNow)
+        # end tracking on active task(s) and start the task in one transaction
+        endedTasks, utcNow = taskdb.switchTask(dbConn, taskID, utcNow)
+        _printEnded(endedTasks, utcNow, silent=True)
+        localNow = utc_to_local(utcNow)
         print(
             f"'{taskRows[1]}' tracking started {localNow.strftime('%Y-%m-%d %H:%M:%S %z')}")
         logger.debug(
             f"'{taskRows[1]}' tracking local: {localNow} DBTime: {utcNow}")
     else:  # Nothing found
+        # end tracking on active task(s)
+        deactivateTasks(dbConn, utcNow, silent=True)
         logger.debug("task name not found")
         print(f"'{taskName}' - NOT FOUND")
 
 
+def trackTaskJournal(dbConn, journalFile, taskName):
+    """Journal a start time track for task name, ending tracking on active task.
+    The tracking table is updated when the journal is compacted."""
+    utcNow = local_to_utc(datetime.now())
+    localNow = utc_to_local(utcNow)
+
+    taskRows = taskdb.getTaskID(dbConn, taskName)
+    if taskRows:
+        taskdb.appendJournal(journalFile, 'T', utcNow, taskID=taskRows[0])
+        print(
+            f"'{taskRows[1]}' tracking started {localNow.strftime('%Y-%m-%d %H:%M:%S %z')}")
+        logger.debug(
+            f"'{taskRows[1]}' journal tracking local: {localNow} DBTime: {utcNow}")
+    else:  # Nothing found
+        # end tracking on active task(s)
+        taskdb.appendJournal(journalFile, 'E', utcNow)
+        logger.debug("task name not found")
+        print(f"'{taskName}' - NOT FOUND")
+
+
+def deactivateTasksJournal(journalFile, utc_dt):
+    """Journal end tracking on active task(s)
+
+    PARM:
+    journalFile : journal file name
+    utc_dt : UTC time value for endtime on active task(s)
+    """
+    taskdb.appendJournal(journalFile, 'E', utc_dt)
+    localNow = utc_to_local(utc_dt)
+    print(
+        f"Active task(s) tracking ended {localNow.strftime('%Y-%m-%d %H:%M:%S %z')}")
+    logger.debug("End track journaled")
+
+
 def purgeWrkHours(dbConn, daysOld, taskName=None):
     """Purge work detail records from database that are daysOld and optionaly just for a specific taskName"""
     msg = f"Purging work hour records older than {daysOld}"
@@ -209,13 +296,16 @@ def purgeWrkHours(dbConn, daysOld, taskName=None):
     print(msg)
 
 
-def reportHours(dbConn, startDate, endDate, taskName=None, exportFile=None):
+def reportHours(dbConn, startDate, endDate, taskName=None, exportFile=None, useCache=True, live=False, rollup=None):
     """Report hourse worked
     PARMS:
     startDate : datetime - Start datetime for report.
     endDate : datetime - End datetime for report (This date will be included).
     taskName : (optional) TaskName to report
     exportFile : Export file name to output csv data
+    useCache : False - do not use the report cache
+    live : True - include hours on task(s) being tracked now
+    rollup : (optional) 'project' or 'tag' - roll hours up to projects or tags
 
     RETURN - nothing
     """
@@ -259,12 +349,21 @@ def reportHours(dbConn, startDate, endDate, taskName=None, exportFile=None):
         if taskRow:  # Task found
             taskName = taskRow[1]
             logger.debug(f"converted taskName -> {taskName}")
-            preMsg = f"Reporting on task: '{taskName}'"
+            if rollup == 'project':
+                preMsg = f"Reporting on project: '{taskName}'"
+            elif rollup == 'tag':
+                preMsg = f"Reporting tags of project: '{taskName}'"
+            else:
+                preMsg = f"Reporting on task: '{taskName}'"
         else:  # Task not found in database
             logger.info(
                 f"Not able to report on task '{taskName}' - it was not found")
             print(f"Not able to find task '{taskName}'")
             return
+    elif rollup == 'project':
+        preMsg = f"Reporting all projects"
+    elif rollup == 'tag':
+        preMsg = f"Reporting all tags"
     else:
         preMsg = f"Reporting all tasks"
 
@@ -274,7 +373,8 @@ def reportHours(dbConn, startDate, endDate, taskName=None, exportFile=None):
         f"{preMsg} from {startLocal.strftime('%Y-%m-%d')} to {lastLocal.strftime('%Y-%m-%d')}")
     # Fetch report rows from database
     rptRows = taskdb.rptHours(
-        dbConn, taskName=taskName, startDateUTC=startUTC, endDateUTC=lastUTC)
+        dbConn, taskName=taskName, startDateUTC=startUTC, endDateUTC=lastUTC, useCache=useCache, live=live,
+        rollup=rollup)
     logger.debug(f"Rows returned: {len(rptRows)}")
 
     if rptRows:  # Have Hours to report
@@ -305,6 +405,122 @@ def reportHours(dbConn, startDate, endDate, taskName=None, exportFile=None):
         print("No work hours to report")
 
 
+def checkTracking(dbConn, repair=False):
+    """Report (and optionally repair) problems with tracked intervals
+    PARMS:
+    dbConn : Database connection object
+    repair : True - repair the issues found
+
+    RETURN - nothing
+    """
+    logger.info(f"Checking tracking intervals. repair: {repair}")
+    if repair:  # Get confirmation
+        confirm = input("  !! Type 'CONFIRM' to repair tracking : ")
+        if confirm != 'CONFIRM':
+            msg = "Tracking not checked. User did not confirm to repair."
+            logger.info(msg)
+            print(msg)
+            return
+
+    issueCount = 0
+    notRepaired = 0
+    for issue in taskdb.checkTracking(dbConn, repair=repair):
+        issueCount += 1
+        issueName, trackID, taskID, started, ended, otherTrackID = issue
+        if issueName in taskdb.CHECK_NOT_REPAIRED:
+            notRepaired += 1
+        msg = f"\t{issueName}: TrackID {trackID} TaskID {taskID} started {started} ended {ended}"
+        if otherTrackID:
+            msg = msg + f" (TrackID {otherTrackID})"
+        logger.info(msg)
+        print(msg)
+
+    if issueCount == 0:
+        msg = "No tracking issues found"
+    elif repair:
+        msg = f"Tracking issues repaired: {issueCount - notRepaired}"
+        if notRepaired:
+            msg = msg + f" not repaired (fix manually): {notRepaired}"
+    else:
+        msg = f"Tracking issues found: {issueCount}"
+    logger.info(msg)
+    print(msg)
+
+
+def backupDB(dbConn, backupFile=None, pagesPerStep=100, sleepSecs=0.05, compress=False, verify=True):
+    """Backup the database while it is in use
+    PARMS:
+    dbConn : Database connection object
+    backupFile : (optional) backup file name. Default data/backup/tasktracking-<local time>.db
+    pagesPerStep : pages copied per step
+    sleepSecs : seconds to sleep between steps
+    compress : True - gzip the backup
+    verify : True - integrity check the backup
+
+    RETURN - nothing
+    """
+    if not backupFile:
+        backupFile = f"data/backup/tasktracking-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db"
+    xpath = Path(backupFile)
+    xpath.parent.mkdir(parents=True, exist_ok=True)
+    logger.info(f"Backing up database to {backupFile}")
+    print(f"Backing up database to {backupFile}")
+    result = taskdb.backupDB(dbConn, backupFile, pagesPerStep=pagesPerStep,
+                             sleepSecs=sleepSecs, compress=compress, verify=verify)
+    if result is None:
+        msg = f"Backup '{backupFile}' failed integrity check see logs"
+    elif verify:
+        msg = f"Backup complete and verified : {result}"
+    else:
+        msg = f"Backup complete : {result}"
+    logger.info(msg)
+    print(msg)
+
+
+def exportChanges(dbConn, sinceSeq=0, outFile=None):
+    """Write changes since the sinceSeq watermark as JSON lines
+    PARMS:
+    dbConn : Database connection object
+    sinceSeq : Only changes after this sequence number
+    outFile : (optional) file to write to. Default is the console
+
+    RETURN - nothing
+    """
+    logger.info(f"Exporting changes since {sinceSeq} to {outFile}")
+    if outFile:
+        xpath = Path(outFile)
+        xpath.parent.mkdir(parents=True, exist_ok=True)
+        out = open(outFile, mode='w', newline='\n')
+    else:
+        out = sys.stdout
+
+    lastSeq = sinceSeq
+    changeCount = 0
+    for change in taskdb.getChanges(dbConn, sinceSeq):
+        out.write(json.dumps(change) + "\n")
+        lastSeq = change['seq']
+        changeCount += 1
+
+    if outFile:
+        out.close()
+        print(f"Changes exported to : {outFile}")
+    logger.info(f"Changes exported: {changeCount} last seq: {lastSeq}")
+
+
+def pruneChanges(dbConn, uptoSeq):
+    """Delete changes up to the uptoSeq watermark once they have been consumed
+    PARMS:
+    dbConn : Database connection object
+    uptoSeq : Changes up to and including this sequence number are deleted
+
+    RETURN - nothing
+    """
+    rowsDeleted = taskdb.pruneChanges(dbConn, uptoSeq)
+    msg = f"Changes pruned up to seq {uptoSeq}: {rowsDeleted}"
+    logger.info(msg)
+    print(msg)
+
+
 def utc_to_local(utc_dt):
     """ converts utc time to local time
 
@@ -353,23 +569,41 @@ def main(parser):
     dbFile = "data/tasktracking.db"
     path = Path(dbFile)
     path.parent.mkdir(parents=True, exist_ok=True)
-    trackingDB = taskdb.create_connection(dbFile)
+    journalFile = "data/tasktracking.journal"
     args = parser.parse_args()
+    trackingDB = taskdb.create_connection(dbFile, busyTimeout=args.timeout)
     logger.debug(f"args is {args}")
+    # Only journal writes skip compaction, everything else sees the journal applied
+    if args.journal and args.command in (None, 'track'):
+        compacted = 0
+    else:
+        compacted = taskdb.compactJournal(trackingDB, journalFile)
+
     if args.e:  # End tracking
         logger.info("option to end task tracking")
         utcNow = local_to_utc(datetime.now())
-        deactivateTasks(trackingDB, utcNow)
+        if args.journal:
+            deactivateTasksJournal(journalFile, utcNow)
+        else:
+            deactivateTasks(trackingDB, utcNow)
 
     if args.command == 'list':
         listTask(trackingDB)
     elif args.command == 'track':
-        logger.info(f"Option tracking task: {args.taskname}")
-        trackTask(trackingDB, args.taskname)
+        logger.info(f"Option tracking task: {args.taskname} journal: {args.journal}")
+        if args.journal:
+            trackTaskJournal(trackingDB, journalFile, args.taskname)
+        else:
+            trackTask(trackingDB, args.taskname)
+    elif args.command == 'compact':
+        msg = f"Journal events compacted: {compacted}"
+        logger.info(msg)
+        print(msg)
     elif args.command == 'report':
         logger.info(f"Reporting command")
         reportHours(trackingDB, args.startdate, args.lastdate,
-                    taskName=args.taskName, exportFile=args.exportfile)
+                    taskName=args.taskName, exportFile=args.exportfile, useCache=not args.nocache,
+                    live=args.live, rollup=args.rollup)
     elif args.command == 'delete':
         logger.info(f"Deleting task '{args.taskname}'")
         deleteTask(trackingDB, taskName=args.taskname)
@@ -384,21 +618,42 @@ def main(parser):
     elif args.command == 'edit':
         logger.info(f"Option Edit task '{args.taskname}'")
         editTask(trackingDB, orgTaskName=args.taskname,
-                 newTaskName=args.newName, newTaskDesc=args.newDesc)
+                 newTaskName=args.newName, newTaskDesc=args.newDesc, newParent=args.newParent)
+    elif args.command == 'tag':
+        logger.info(f"Option tag task '{args.taskname}' tag '{args.tagname}' remove: {args.remove}")
+        tagTask(trackingDB, args.taskname, args.tagname, remove=args.remove)
     elif args.command == 'purge':
         logger.info(
             f"Option purge task working hours older than {args.daysOld}")
         purgeWrkHours(trackingDB, args.daysOld, taskName=args.taskName)
+    elif args.command == 'backup':
+        logger.info(f"Option backup database to '{args.backupfile}'")
+        backupDB(trackingDB, args.backupfile, pagesPerStep=args.pages, sleepSecs=args.sleep,
+                 compress=args.compress, verify=not args.noverify)
+    elif args.command == 'changes' and args.prune is not None:
+        logger.info(f"Option changes prune up to {args.prune}")
+        pruneChanges(trackingDB, args.prune)
+    elif args.command == 'changes':
+        logger.info(f"Option changes since {args.since}")
+        exportChanges(trackingDB, args.since, outFile=args.outfile)
+    elif args.command == 'check':
+        logger.info(f"Option check tracking. repair: {args.repair}")
+        checkTracking(trackingDB, repair=args.repair)
 
 
 if __name__ == '__main__':
     logger.info("======= START ======= ")
     msg = f"Task Tracker version: {APP_VER}"
     logger.info(msg)
-    print(msg)
+    # changes writes JSON lines to the console, so stdout is kept for them
+    print(msg, file=sys.stderr if 'changes' in sys.argv[1:] else sys.stdout)
 
     parser = argparse.ArgumentParser(description="Task Tracking app")
     parser.add_argument('-e', help='End tracking', action='store_true')
+    parser.add_argument('-j', '--journal', help='Journal track/end tracking (applied on next read or compact)',
+                        action='store_true', dest='journal')
+    parser.add_argument('--timeout', help=f'Seconds to wait for a busy database (default {taskdb.DEFAULT_BUSY_TIMEOUT})',
+                        metavar='seconds', type=float, default=taskdb.DEFAULT_BUSY_TIMEOUT, dest='timeout')
 
     commandSubparser = parser.add_subparsers(
         title="Commands", dest='command')
@@ -412,6 +667,47 @@ if __name__ == '__main__':
     addTaskGroup.add_argument(
         '-d', '--desc', help='Description of task',  metavar='taskdesc', type=str, dest='taskdesc')
 
+    # Backup command - Online backup of the database
+    backup_parser = commandSubparser.add_parser(
+        'backup', help='Backup the database')
+    backupGroup = backup_parser.add_argument_group(
+        "Backup Command (Backup the database)")
+    backupGroup.add_argument(
+        'backupfile', help='Backup file name (default data/backup/tasktracking-<datetime>.db)', nargs='?', type=str)
+    backupGroup.add_argument(
+        '-p', '--pages', help='Pages copied per step (default 100)', metavar='pages', type=int, default=100, dest='pages')
+    backupGroup.add_argument(
+        '-s', '--sleep', help='Seconds to sleep between steps (default 0.05)', metavar='seconds', type=float, default=0.05, dest='sleep')
+    backupGroup.add_argument(
+        '-z', '--compress', help='gzip compress the backup', action='store_true', dest='compress')
+    backupGroup.add_argument(
+        '--noverify', help='Skip the integrity check of the backup', action='store_true', dest='noverify')
+
+    # Changes command - Change feed for task and tracking
+    changes_parser = commandSubparser.add_parser(
+        'changes', help='Changes to tasks and tracking as JSON lines')
+    changesGroup = changes_parser.add_argument_group(
+        "Changes Command (Change feed)")
+    changesGroup.add_argument(
+        '-s', '--since', help='Changes after this sequence number (default 0)', metavar='seq', type=int, default=0, dest='since')
+    changesGroup.add_argument(
+        '-o', '--output', help='Write changes to a file', metavar='outfile', type=str, dest='outfile')
+    changesGroup.add_argument(
+        '-p', '--prune', help='Delete changes up to this sequence number (consumed watermark) instead of exporting',
+        metavar='seq', type=int, dest='prune')
+
+    # Check command - Check tracking records for bad intervals
+    check_parser = commandSubparser.add_parser(
+        'check', help='Check tracked hours for overlaps and bad intervals')
+    checkTaskGroup = check_parser.add_argument_group(
+        "Check Command (Check tracked hours)")
+    checkTaskGroup.add_argument(
+        '-r', '--repair', help='Repair the issues found', action='store_true', dest='repair')
+
+    # Compact command - Apply journaled tracking to the database
+    compact_parser = commandSubparser.add_parser(
+        'compact', help='Apply journaled tracking to the database')
+
     # Delete command (Deleting a task)
     delTask_parser = commandSubparser.add_parser(
         'delete', help='Delete a task')
@@ -430,6 +726,8 @@ if __name__ == '__main__':
         '-n', '--newName', help='New name for task', metavar='new_name', type=str, dest='newName')
     editTaskGroup.add_argument(
         '-d', '--newDesc', help='New description task',  metavar='new_desc', type=str, dest='newDesc')
+    editTaskGroup.add_argument(
+        '-p', '--parent', help="Parent project task ('' for none)", metavar='parent_name', type=str, dest='newParent')
 
     # List command to list task(s) TODO: Want this to work like list WSSEMD*
     list_parser = commandSubparser.add_parser('list', help="List all tasks")
@@ -457,6 +755,23 @@ if __name__ == '__main__':
                                  metavar='lastdate', type=datetime.fromisoformat, dest='lastdate')
     reportTaskGroup.add_argument('-E', '--Export', help='Export to a csv file report',
                                  metavar='exportfile', type=str, dest='exportfile')
+    reportTaskGroup.add_argument('--nocache', help='Do not use the report cache',
+                                 action='store_true', dest='nocache')
+    reportTaskGroup.add_argument('-L', '--live', help='Include hours on task(s) being tracked now',
+                                 action='store_true', dest='live')
+    reportTaskGroup.add_argument('-r', '--rollup', help='Roll hours up to top level projects (or -t project) or tags',
+                                 choices=['project', 'tag'], type=str, dest='rollup')
+
+    # Tag command to tag a task
+    tag_parser = commandSubparser.add_parser('tag', help='Tag a task')
+    tag_parser.add_argument(
+        'taskname', help="Name of the task to tag", type=str)
+    tag_parser.add_argument(
+        'tagname', help="Name of the tag", type=str)
+    tagTaskGroup = tag_parser.add_argument_group(
+        "Tag Command (Tagging a Task)")
+    tagTaskGroup.add_argument(
+        '-r', '--remove', help='Remove the tag from the task', action='store_true', dest='remove')
 
     # Track command to track a task
     track_parser = commandSubparser.add_parser('track', help='Track a task')
@@ -1,16 +1,82 @@
 import logging
+import contextlib
 import datetime
+import gzip
+import json
+import os
+import random
+import shutil
 import sqlite3
 import sys
+import tempfile
+import time
 
-logger = logging.getLogger('taskdb')
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
+logger = logging.getLogger('taskdb')
 
-def create_connection(dbFile):
+# Seconds sqlite waits on a locked database before a write attempt fails
+DEFAULT_BUSY_TIMEOUT = 10.0
+# Write attempts retried after a failed attempt, with jittered backoff (seconds)
+WRITE_RETRIES = 5
+WRITE_BACKOFF = 0.05
+WRITE_BACKOFF_MAX = 2.0
+
+# checkTracking issues left for a manual fix when repairing
+CHECK_NOT_REPAIRED = ('bad_started',)
+
+# Report cache eviction limits
+RPT_CACHE_MAX_ENTRIES = 100
+RPT_CACHE_MAX_AGE_DAYS = 30
+# A cache hit only writes last_used when it is older than this, so most hits do no write
+RPT_CACHE_TOUCH_HOURS = 24
+# Seconds a report cache write waits on a locked database before it is skipped
+RPT_CACHE_BUSY_TIMEOUT = 0.1
+_rptCacheStats = {'hits': 0, 'misses': 0}
+
+# change_log data column per table, {row} is NEW/OLD or the table name
+_CHANGE_DATA = {
+    'task': "json_object('id', {row}.id, 'name', {row}.name, 'desc', {row}.desc)",
+    'tracking': "json_object('id', {row}.id, 'task_id', {row}.task_id, 'started', {row}.started, 'ended', {row}.ended)",
+    'task_closure': "json_object('ancestor_id', {row}.ancestor_id, 'descendant_id', {row}.descendant_id, 'depth', {row}.depth)",
+    'tag': "json_object('id', {row}.id, 'name', {row}.name)",
+    'task_tag': "json_object('task_id', {row}.task_id, 'tag_id', {row}.tag_id)"}
+
+# Report rollups. grp is the task (project) or tag hours are rolled up to
+_ROLLUP_SQL = {
+    'project': {
+        'join': """JOIN task_closure AS tc ON tc.descendant_id = wrk.task_id
+    JOIN task AS grp ON grp.id = tc.ancestor_id """,
+        'desc': "grp.desc",
+        # Top level projects, or the project named taskName
+        'where': """AND NOT EXISTS (SELECT 1 FROM task_closure AS up
+    WHERE up.descendant_id = grp.id AND up.depth > 0) """,
+        'whereTask': "AND grp.name = :taskName "},
+    'tag': {
+        # A task has its own tags and the tags of its parent projects.
+        # Only the nearest task/project with the tag counts, so hours are not doubled.
+        'join': """JOIN task_closure AS tc ON tc.descendant_id = wrk.task_id
+    JOIN task_tag AS tt ON tt.task_id = tc.ancestor_id AND NOT EXISTS (SELECT 1 FROM task_closure AS near
+    JOIN task_tag AS nearTag ON nearTag.task_id = near.ancestor_id
+    WHERE near.descendant_id = wrk.task_id AND nearTag.tag_id = tt.tag_id AND near.depth < tc.depth)
+    JOIN tag AS grp ON grp.id = tt.tag_id """,
+        'desc': "NULL",
+        'where': "",
+        # Tags within the project named taskName
+        'whereTask': """AND wrk.task_id IN (SELECT sub.descendant_id FROM task_closure AS sub
+    JOIN task AS proj ON proj.id = sub.ancestor_id WHERE proj.name = :taskName) """}}
+
+
+def create_connection(dbFile, busyTimeout=DEFAULT_BUSY_TIMEOUT):
     """Create a Sqlite3 datbase connection to dbfile
 
     Args:
       dbfile : database file to connect
+      busyTimeout : seconds to wait for a locked database
     Returns:
       Sqlite3 connection object or None
     """
@@ -19,10 +85,16 @@ def create_connection(dbFile):
         logger.critical(f"This is a value error", exc_info=True)
         raise ValueError("dbFile must contain a value")
     try:
-        conn = sqlite3.connect(dbFile)
+        conn = sqlite3.connect(dbFile, timeout=busyTimeout)
         cur = conn.cursor()
         # Turning on foreign_key enforcement
         cur.execute("PRAGMA foreign_keys = ON")
+        # The change_log triggers need the JSON1 extension
+        try:
+            cur.execute("SELECT json_object('a', 1)")
+        except sqlite3.OperationalError:
+            raise RuntimeError(
+                f"sqlite {sqlite3.sqlite_version} does not have the JSON1 extension. SQLite 3.9 or later with JSON1 is needed")
 
         logger.debug(f"DB Connection successful to : {dbFile}")
         logger.debug(f"sqlite3 version {sqlite3.version}")
@@ -36,7 +108,7 @@ def create_connection(dbFile):
     c.execute(sql)
     if c.fetchone() is None:  # Creating task table
         logger.info(f"Creating task table")
-        createSql = """CREATE TABLE task (
+        createSql = """CREATE TABLE IF NOT EXISTS task (
         id   INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
         name TEXT UNIQUE NOT NULL COLLATE NOCASE,
         [desc] TEXT)"""
@@ -47,7 +119,7 @@ def create_connection(dbFile):
     c.execute(sql)
     if c.fetchone() is None:  # Creating tracking table
         logger.info(f"Creating tracking table")
-        createSql = """CREATE TABLE tracking (
+        createSql = """CREATE TABLE IF NOT EXISTS tracking (
         id      INTEGER  PRIMARY KEY AUTOINCREMENT UNIQUE NOT NULL,
         task_id INTEGER  REFERENCES task (id) ON DELETE CASCADE
                                         ON UPDATE CASCADE,
@@ -55,7 +127,26 @@ def create_connection(dbFile):
         ended   DATETIME)"""
         _exeSql(conn, createSql)
 
-    sql = "SELECT name FROM sqlite_master WHERE name='v_hours_wrked_detail'"
+    sql = "SELECT name FROM sqlite_master WHERE name='idx_tracking_open'"
+    c = conn.cursor()
+    c.execute(sql)
+    if c.fetchone() is None:  # Create the running interval index
+        logger.info(f"Creating idx_tracking_open")
+        createSql = """CREATE INDEX IF NOT EXISTS idx_tracking_open ON tracking (started)
+        WHERE ended = '' OR ended IS NULL"""
+        _exeSql(conn, createSql)
+
+    sql = "SELECT name FROM sqlite_master WHERE name='idx_tracking_task'"
+    c = conn.cursor()
+    c.execute(sql)
+    if c.fetchone() is None:  # Create the index for task_id lookups (foreign key)
+        logger.info(f"Creating idx_tracking_task")
+        createSql = """CREATE INDEX IF NOT EXISTS idx_tracking_task ON tracking (task_id)"""
+        _exeSql(conn, createSql)
+
+    # Older databases have the view with ORDER BY (stops the view being
+    # flattened into report queries) and without task_desc.
+    sql = "SELECT name FROM sqlite_master WHERE name='v_hours_wrked_detail' AND sql LIKE '%task_desc%'"
     c = conn.cursor()
     c.execute(sql)
     if c.fetchone() is None:  # Create the v_hours_wrked_detail view
@@ -63,6 +154,7 @@ def create_connection(dbFile):
         createSql = """CREATE VIEW v_hours_wrked_detail AS
         SELECT task.id AS task_id,
         task.name AS task_name,
+        task.desc AS task_desc,
         track.id AS track_id,
         track.started,
         track.ended,
@@ -70,28 +162,140 @@ def create_connection(dbFile):
         FROM task
         JOIN
         tracking AS track ON task.id = track.task_id
-        WHERE NOT track.ended IS NULL
-        ORDER BY started"""
+        WHERE NOT track.ended IS NULL"""
+        _exeSql(conn, "DROP VIEW IF EXISTS v_hours_wrked_detail", [createSql], sql)
+
+    sql = "SELECT name FROM sqlite_master WHERE name='change_log'"
+    c = conn.cursor()
+    c.execute(sql)
+    if c.fetchone() is None:  # Creating change_log table
+        logger.info(f"Creating change_log table")
+        createSql = """CREATE TABLE IF NOT EXISTS change_log (
+        seq     INTEGER  PRIMARY KEY AUTOINCREMENT NOT NULL,
+        tbl     TEXT     NOT NULL,
+        op      TEXT     NOT NULL,
+        row_id  INTEGER  NOT NULL,
+        changed DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f+00:00', 'now')),
+        data    TEXT)"""
+        # Existing rows are logged as inserts so a feed from 0 is complete
+        seedSql = [f"""INSERT INTO change_log (tbl, op, row_id, data)
+        SELECT 'task', 'insert', id, {_CHANGE_DATA['task'].format(row='task')} FROM task""",
+                   f"""INSERT INTO change_log (tbl, op, row_id, data)
+        SELECT 'tracking', 'insert', id, {_CHANGE_DATA['tracking'].format(row='tracking')} FROM tracking"""]
+        _exeSql(conn, createSql, seedSql, sql)
+
+    sql = "SELECT name FROM sqlite_master WHERE name='task_closure'"
+    c = conn.cursor()
+    c.execute(sql)
+    if c.fetchone() is None:  # Creating task_closure table
+        logger.info(f"Creating task_closure table")
+        createSql = """CREATE TABLE IF NOT EXISTS task_closure (
+        ancestor_id   INTEGER NOT NULL REFERENCES task (id) ON DELETE CASCADE,
+        descendant_id INTEGER NOT NULL REFERENCES task (id) ON DELETE CASCADE,
+        depth         INTEGER NOT NULL,
+        PRIMARY KEY (ancestor_id, descendant_id))"""
+        # Every task is its own ancestor at depth 0
+        seedSql = ["CREATE INDEX IF NOT EXISTS idx_task_closure_desc ON task_closure (descendant_id, depth, ancestor_id)",
+                   "INSERT OR IGNORE INTO task_closure (ancestor_id, descendant_id, depth) SELECT id, id, 0 FROM task"]
+        _exeSql(conn, createSql, seedSql, sql)
+
+    sql = "SELECT name FROM sqlite_master WHERE name='trg_task_closure_add'"
+    c = conn.cursor()
+    c.execute(sql)
+    if c.fetchone() is None:  # Create the trigger adding new tasks to task_closure
+        logger.info(f"Creating trg_task_closure_add")
+        createSql = """CREATE TRIGGER IF NOT EXISTS trg_task_closure_add AFTER INSERT ON task
+        BEGIN
+        INSERT INTO task_closure (ancestor_id, descendant_id, depth) VALUES (NEW.id, NEW.id, 0);
+        END"""
+        _exeSql(conn, createSql)
+
+    sql = "SELECT name FROM sqlite_master WHERE name='trg_task_closure_detach'"
+    c = conn.cursor()
+    c.execute(sql)
+    if c.fetchone() is None:  # Create the trigger detaching sub tasks of a deleted task
+        logger.info(f"Creating trg_task_closure_detach")
+        createSql = """CREATE TRIGGER IF NOT EXISTS trg_task_closure_detach BEFORE DELETE ON task
+        BEGIN
+        DELETE FROM task_closure
+        WHERE descendant_id IN (SELECT descendant_id FROM task_closure WHERE ancestor_id = OLD.id)
+        AND ancestor_id IN (SELECT ancestor_id FROM task_closure WHERE descendant_id = OLD.id AND depth > 0);
+        END"""
         _exeSql(conn, createSql)
 
+    sql = "SELECT name FROM sqlite_master WHERE name='tag'"
+    c = conn.cursor()
+    c.execute(sql)
+    if c.fetchone() is None:  # Creating tag and task_tag tables
+        logger.info(f"Creating tag table")
+        createSql = """CREATE TABLE IF NOT EXISTS tag (
+        id   INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE,
+        name TEXT UNIQUE NOT NULL COLLATE NOCASE)"""
+        seedSql = ["""CREATE TABLE IF NOT EXISTS task_tag (
+        task_id INTEGER NOT NULL REFERENCES task (id) ON DELETE CASCADE,
+        tag_id  INTEGER NOT NULL REFERENCES tag (id) ON DELETE CASCADE,
+        PRIMARY KEY (task_id, tag_id))""",
+                   "CREATE INDEX IF NOT EXISTS idx_task_tag_tag ON task_tag (tag_id, task_id)"]
+        _exeSql(conn, createSql, seedSql, sql)
+
+    sql = "SELECT name FROM sqlite_master WHERE name='rpt_cache'"
+    c = conn.cursor()
+    c.execute(sql)
+    if c.fetchone() is None:  # Creating rpt_cache table
+        logger.info(f"Creating rpt_cache table")
+        createSql = """CREATE TABLE IF NOT EXISTS rpt_cache (
+        cache_key TEXT     PRIMARY KEY NOT NULL,
+        write_seq INTEGER  NOT NULL,
+        created   DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f+00:00', 'now')),
+        last_used DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f+00:00', 'now')),
+        hits      INTEGER  NOT NULL DEFAULT 0,
+        rows      TEXT     NOT NULL)"""
+        _exeSql(conn, createSql)
+
+    for tblName, rowData in _CHANGE_DATA.items():
+        for op, row in (('insert', 'NEW'), ('update', 'NEW'), ('delete', 'OLD')):
+            trgName = f"trg_{tblName}_{op}_log"
+            sql = f"SELECT name FROM sqlite_master WHERE name='{trgName}'"
+            c = conn.cursor()
+            c.execute(sql)
+            if c.fetchone() is None:  # Create the change_log trigger
+                logger.info(f"Creating {trgName}")
+                createSql = f"""CREATE TRIGGER IF NOT EXISTS {trgName} AFTER {op.upper()} ON {tblName}
+                BEGIN
+                INSERT INTO change_log (tbl, op, row_id, data)
+                VALUES ('{tblName}', '{op}', {row}.rowid, {rowData.format(row=row)});
+                END"""
+                _exeSql(conn, createSql)
+
     logger.info("Database Connection created")
     return conn
 
 
-def _exeSql(dbConn, exeSql):
+def _exeSql(dbConn, exeSql, moreSql=(), checkSql=None):
     """Executes exeSql.
 
     Args:
       dbConn    : database connection obj
-      createSql : Create table sql statment
+      exeSql    : Create sql statment
+      moreSql   : sql statements to run in the same transaction after exeSql
+      checkSql  : sql that returns a row if exeSql is not needed (another
+                  connection has already created the object)
     Returns:
       True if successfull
     """
     logger.debug(f"executing sql: {exeSql}")
+
+    def exeTxn(cursor):
+        if checkSql and cursor.execute(checkSql).fetchone():
+            logger.debug(f"sql not needed. checkSql: {checkSql}")
+            return
+        cursor.execute(exeSql)
+        for sql in moreSql:
+            logger.debug(f"executing sql: {sql}")
+            cursor.execute(sql)
+
     try:
-        dbCursor = dbConn.cursor()
-        dbCursor.execute(exeSql)
-        dbConn.commit()
+        _writeTxn(dbConn, exeTxn)
         logger.debug(f"sql executed successfull")
         return True
     except Exception as err:
@@ -99,6 +303,48 @@ def _exeSql(dbConn, exeSql):
         sys.exit()
 
 
+def _writeTxn(dbConn, txnFunc, retries=WRITE_RETRIES):
+    """Run txnFunc(cursor) in a BEGIN IMMEDIATE transaction and commit
+
+    The write lock is taken at BEGIN, so the transaction can not fail part
+    way with a locked database. If the database stays locked longer than
+    the connection busy timeout the transaction is retried up to
+    retries times with a jittered exponential backoff.
+
+    Args:
+      dbConn   : database connection obj
+      txnFunc  : function(cursor) doing the writes. Called again on retry.
+      retries  : number of retries on a locked database
+
+    Returns:
+      what txnFunc returns
+    """
+    attempt = 0
+    while True:
+        cursor = dbConn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            result = txnFunc(cursor)
+            dbConn.commit()
+            return result
+        except sqlite3.OperationalError as err:
+            if dbConn.in_transaction:
+                dbConn.rollback()
+            busy = "locked" in str(err) or "busy" in str(err)
+            if not busy or attempt >= retries:
+                raise
+            delay = min(WRITE_BACKOFF_MAX, WRITE_BACKOFF * 2 ** attempt)
+            delay = delay * random.uniform(0.5, 1.5)
+            attempt += 1
+            logger.info(
+                f"Database busy: {err}. Retry {attempt} of {retries} in {delay:.3f} seconds")
+            time.sleep(delay)
+        except Exception:
+            if dbConn.in_transaction:
+                dbConn.rollback()
+            raise
+
+
 def getTasks(dbConn):
     """Gets a list of tasks
 
@@ -167,9 +413,7 @@ def addTask(dbConn, taskName="", taskDesc=""):
     logger.debug(f"SQL: {sql}")
     logger.debug(f"theVals: {theVals}")
     try:
-        dbCursor = dbConn.cursor()
-        dbCursor.execute(sql, theVals)
-        dbConn.commit()
+        _writeTxn(dbConn, lambda cursor: cursor.execute(sql, theVals))
     except sqlite3.IntegrityError as err:
         # UNIQUE constraint failed
         logger.info(f"Integrity Error={err}.")
@@ -212,9 +456,7 @@ def changeTask(dbConn, taskID, newName=None, newDesc=None):
     logger.debug(f"SQL: {sql}")
     logger.debug(f"theVals: {theVals}")
     try:
-        dbCursor = dbConn.cursor()
-        dbCursor.execute(sql, theVals)
-        dbConn.commit()
+        _writeTxn(dbConn, lambda cursor: cursor.execute(sql, theVals))
     except sqlite3.IntegrityError as err:
         # UNIQUE constraint failed
         logger.debug(f"Integrity Error={err}.")
@@ -226,45 +468,98 @@ def changeTask(dbConn, taskID, newName=None, newDesc=None):
     return True
 
 
-def setTaskTrack(dbConn, taskID, timeValue, trackID=None):
-    """Start or end tracking for a Task
+def _endActive(cursor, timeValue):
+    """End tracking on active task(s) at timeValue. Called inside a write transaction.
+
+    An interval is never ended before it started.
+
+    Returns:
+      list (TaskID, TaskName, Tracking_id)
+    """
+    selectSQL = """SELECT task.id, task.name, track.id FROM tracking AS track
+    JOIN task ON task.id = track.task_id
+    WHERE track.ended = '' OR track.ended IS NULL
+    ORDER BY task.name"""
+    updateSQL = """UPDATE tracking SET ended = CASE
+    WHEN julianday(:timeValue) < julianday(started) THEN started ELSE :timeValue END
+    WHERE ended = '' OR ended IS NULL"""
+    theVals = {'timeValue': timeValue}
+    logger.debug(f"SQL: {selectSQL}")
+    logger.debug(f"SQL: {updateSQL}")
+    logger.debug(f"theVals: {theVals}")
+    rows = cursor.execute(selectSQL).fetchall()
+    cursor.execute(updateSQL, theVals)
+    return rows
+
+
+def endActiveTasks(dbConn, timeValue):
+    """End tracking on active task(s) in one write transaction
+
+    Args:
+      dbConn: database connection obj
+      timeValue: The UTC time value for ending
+
+    Returns:
+      list (TaskID, TaskName, Tracking_id) of the tracking ended
+    """
+    logger.info(f"Ending tracking on active tasks endtime {timeValue}")
+    try:
+        rows = _writeTxn(dbConn, lambda cursor: _endActive(cursor, timeValue))
+    except Exception as err:
+        logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+        sys.exit()
+
+    logger.info(f"tracking ended: {rows}")
+    return rows
+
+
+def switchTask(dbConn, taskID, timeValue):
+    """End tracking on active task(s) and start tracking taskID in one write transaction
+
+    Concurrent switches are serialized by the write lock. If timeValue is
+    not after the latest started time (another switch got the lock first
+    with a later time) the start is moved to a millisecond after it, so
+    switches are never lost and intervals never overlap. The times are
+    compared in sql with julianday, so a started that is naive or not a
+    valid time can not break the switch.
 
     Args:
       dbConn: database connection obj
       taskID: Unique ID for the task that is going to be tracked
-      timeValue: The UTC time value for starting/ending
-      trackID: If provided timeValue is the endtime.
-                If not provided new trackID record, with timeValue as starttime.
+      timeValue: datetime obj in UTC time for the switch
 
     Returns:
-      True/False (True worked, False did not work)
+      tuple(list (TaskID, TaskName, Tracking_id) of the tracking ended, starttime used)
     """
-    if trackID:  # trackID has been provided
-        logger.info(
-            f"UPDATE trackingID: {trackID} for taskID {taskID} endtime {f'{timeValue}'}.")
-        theVals = (timeValue, trackID)
-        sql = "UPDATE tracking SET ended = ? WHERE id = ?"
-    else:
-        logger.info(
-            f"Creating trackingID: for taskID {taskID}, startime {f'{timeValue}'}")
-        theVals = (taskID, timeValue)
-        sql = "INSERT into tracking (task_id, started) VALUES(?,?)"
-    logger.debug(f"SQL: {sql}")
-    logger.debug(f"Values: {theVals}")
+    logger.info(f"Switching tracking to taskID {taskID} time {timeValue}")
+    # Start time moved after the latest started, NULL if not needed.
+    # Only started values beginning with a digit are read, so text that is
+    # not a time (sorting after every time) can not hide the latest started.
+    latestSQL = """SELECT CASE WHEN julianday(max(started)) >= julianday(:timeValue)
+    THEN strftime('%Y-%m-%d %H:%M:%f', max(started), '+0.001 seconds') END FROM tracking
+    WHERE started >= '0' AND started < ':'"""
+    insertSQL = "INSERT into tracking (task_id, started) VALUES(?,?)"
+    logger.debug(f"SQL: {latestSQL}")
+    logger.debug(f"SQL: {insertSQL}")
+
+    def switchTxn(cursor):
+        startTime = timeValue
+        moved = cursor.execute(latestSQL, {'timeValue': timeValue}).fetchone()[0]
+        if moved:
+            startTime = datetime.datetime.fromisoformat(moved).replace(tzinfo=datetime.timezone.utc)
+            logger.info(f"start moved after latest started to {startTime}")
+        rows = _endActive(cursor, startTime)
+        cursor.execute(insertSQL, (taskID, startTime))
+        return rows, startTime
+
     try:
-        dbCursor = dbConn.cursor()
-        dbCursor.execute(sql, theVals)
-        dbConn.commit()
-    except sqlite3.IntegrityError as err:
-        # UNIQUE constraint failed
-        logger.debug(f"Integrity Error={err}.")
-        return False
+        rows, startTime = _writeTxn(dbConn, switchTxn)
     except Exception as err:
         logger.critical(f"Unexpected Error:  {err}", exc_info=True)
         sys.exit()
 
-    logger.debug("tracking update")
-    return True
+    logger.info(f"tracking ended: {rows} started: {startTime}")
+    return rows, startTime
 
 
 def delTask(dbConn, taskID):
@@ -285,9 +580,7 @@ def delTask(dbConn, taskID):
     logger.debug(f"theVals: {theVals}")
 
     try:
-        cursor = dbConn.cursor()
-        cursor.execute(sql, theVals)
-        dbConn.commit()
+        _writeTxn(dbConn, lambda cursor: cursor.execute(sql, theVals))
     except Exception as err:
         logger.critical(f"Unexpected Error:  {err}", exc_info=True)
         sys.exit()
@@ -323,20 +616,273 @@ def getTaskID(dbConn, taskName):
     return result
 
 
-def rptHours(dbConn, startDateUTC, endDateUTC, taskName=None):
+def setTaskParent(dbConn, taskID, parentID=None):
+    """Set or clear the parent project of a task
+
+    The task and all of its sub tasks move under parentID in task_closure.
+
+    Args:
+      dbConn   : database connection obj
+      taskID   : Unique ID of the task to move
+      parentID : Unique ID of the parent task. None makes it a top level task.
+
+    Returns:
+      True/False
+      False = did not update. parentID is the task or one of its sub tasks
+    """
+    logger.info(f"Setting parent of taskID {taskID} to parentID {parentID}")
+    theVals = {'taskID': taskID, 'parentID': parentID}
+    cycleSQL = """SELECT 1 FROM task_closure
+    WHERE ancestor_id = :taskID AND descendant_id = :parentID"""
+    detachSQL = """DELETE FROM task_closure
+    WHERE descendant_id IN (SELECT descendant_id FROM task_closure WHERE ancestor_id = :taskID)
+    AND ancestor_id IN (SELECT ancestor_id FROM task_closure WHERE descendant_id = :taskID AND depth > 0)"""
+    attachSQL = """INSERT INTO task_closure (ancestor_id, descendant_id, depth)
+    SELECT up.ancestor_id, down.descendant_id, up.depth + down.depth + 1
+    FROM task_closure AS up, task_closure AS down
+    WHERE up.descendant_id = :parentID AND down.ancestor_id = :taskID"""
+    logger.debug(f"SQL: {detachSQL}")
+    logger.debug(f"SQL: {attachSQL}")
+    logger.debug(f"theVals: {theVals}")
+
+    def parentTxn(cursor):
+        if parentID and cursor.execute(cycleSQL, theVals).fetchone():
+            return False
+        cursor.execute(detachSQL, theVals)
+        if parentID:
+            cursor.execute(attachSQL, theVals)
+        return True
+
+    try:
+        result = _writeTxn(dbConn, parentTxn)
+    except Exception as err:
+        logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+        sys.exit()
+
+    logger.info(f"parent set: {result}")
+    return result
+
+
+def tagTask(dbConn, taskID, tagName, remove=False):
+    """Add or remove a tag on a task
+
+    Args:
+      dbConn  : database connection obj
+      taskID  : Unique ID of the task
+      tagName : str name of the tag (case insensitve). Created if needed.
+      remove  : True - remove the tag from the task
+
+    Returns:
+      True/False
+      False = nothing changed. Task already has (or does not have) the tag
+    """
+    logger.info(f"Tag taskID {taskID} tag '{tagName}' remove={remove}")
+    theVals = {'taskID': taskID, 'tagName': tagName}
+    tagSQL = "INSERT OR IGNORE into tag (name) VALUES(:tagName)"
+    addSQL = """INSERT OR IGNORE into task_tag (task_id, tag_id)
+    SELECT :taskID, id FROM tag WHERE name = :tagName"""
+    removeSQL = """DELETE FROM task_tag WHERE task_id = :taskID
+    AND tag_id = (SELECT id FROM tag WHERE name = :tagName)"""
+    logger.debug(f"theVals: {theVals}")
+
+    def tagTxn(cursor):
+        if remove:
+            logger.debug(f"SQL: {removeSQL}")
+            return cursor.execute(removeSQL, theVals).rowcount > 0
+        logger.debug(f"SQL: {tagSQL}")
+        logger.debug(f"SQL: {addSQL}")
+        cursor.execute(tagSQL, theVals)
+        return cursor.execute(addSQL, theVals).rowcount > 0
+
+    try:
+        result = _writeTxn(dbConn, tagTxn)
+    except Exception as err:
+        logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+        sys.exit()
+
+    return result
+
+
+def rptHours(dbConn, startDateUTC, endDateUTC, taskName=None, useCache=True, live=False, rollup=None):
     """Return a list of hours worked by mont for the taskName
 
+    Results are cached in rpt_cache keyed by the UTC dates, taskName and
+    local timezone. A cached result is only used if no task or tracking
+    changes have been made since it was stored (change_log seq).
+    Running intervals (live) are never cached, they are added on top.
+
     Args:
       dbConn: database connection obj
       startDateUTC: datetime obj in UTC time. This is the start time
       endDateUTC: datetime obj in UTC time. This is the end date(inclusive).
       taskName: name of the task looking for. (case insensitve)
+      useCache: False - do not use or update the report cache
+      live: True - include running intervals with hours worked up to now
+      rollup: None - hours per task
+              'project' - hours of each top level project including all
+                          of its sub tasks. With taskName the hours of the
+                          project taskName.
+              'tag' - hours per tag, a task has the tags of its parent
+                      projects. With taskName only tasks in project taskName.
 
     Returns:
       list(trackDateLocal, taskName, hours_Worked, taskDesc)
+      taskName/taskDesc are the project or tag when rolled up
     """
     logger.info(
-        f"startDateUTC: {startDateUTC.isoformat()}, endDateUTC: {endDateUTC.isoformat()}, taskName: {taskName}")
+        f"startDateUTC: {startDateUTC.isoformat()}, endDateUTC: {endDateUTC.isoformat()}, taskName: {taskName}, live: {live}, rollup: {rollup}")
+    if rollup is not None and rollup not in _ROLLUP_SQL:
+        raise ValueError(f"rollup must be one of {list(_ROLLUP_SQL)} not '{rollup}'")
+
+    def closedRows():
+        if rollup:
+            return _rptHoursRollup(dbConn, startDateUTC, endDateUTC, rollup, taskName)
+        return _rptHoursDaily(dbConn, startDateUTC, endDateUTC, taskName)
+
+    if not useCache:
+        rows = closedRows()
+    else:
+        cacheKey = json.dumps([startDateUTC.date().isoformat(), endDateUTC.date().isoformat(),
+                               taskName.lower() if taskName else None, rollup or 'day', time.tzname])
+        # Read before the report so a write during the report makes the entry stale
+        writeSeq = _getWriteSeq(dbConn)
+        rows = _rptCacheGet(dbConn, cacheKey, writeSeq)
+        if rows is None:
+            rows = closedRows()
+            _rptCachePut(dbConn, cacheKey, writeSeq, rows)
+
+    if live:
+        if rollup:
+            openRows = _rptHoursRollup(dbConn, startDateUTC, endDateUTC, rollup, taskName, live=True)
+        else:
+            openRows = _rptHoursOpen(dbConn, startDateUTC, endDateUTC, taskName)
+        if openRows:
+            rows = _mergeRptRows(rows, openRows)
+    return rows
+
+
+def _rptHoursOpen(dbConn, startDateUTC, endDateUTC, taskName=None):
+    """Query hours worked up to now on running intervals, per local day
+
+    Running intervals are found with the idx_tracking_open partial index,
+    nothing is written to the database.
+
+    Args:
+      dbConn: database connection obj
+      startDateUTC: datetime obj in UTC time. This is the start time
+      endDateUTC: datetime obj in UTC time. This is the end date(inclusive).
+      taskName: name of the task looking for. (case insensitve)
+
+    Returns:
+      list(trackDateLocal, taskName, hours_Worked, taskDesc)
+    """
+    theVals = {'taskName': taskName,
+               'startDateUTC': startDateUTC,
+               'endDateUTC': endDateUTC,
+               'nowUTC': datetime.datetime.now(datetime.timezone.utc)}
+    logger.debug(f"theVals: {theVals}")
+    sql = """SELECT strftime("%Y-%m-%d", datetime(strftime("%s", track.started), 'unixepoch', 'localtime')) as trackDateLocal,
+    task.name as task_name, (julianday(:nowUTC) - julianday(track.started)) * 24 as hours_worked, task.desc as task_desc
+    FROM tracking AS track
+    JOIN task ON task.id = track.task_id
+    WHERE (track.ended = '' OR track.ended IS NULL)
+    AND track.started between date(:startDateUTC) and date(:endDateUTC,'+1 day') """
+    if taskName:
+        sql += "AND task.name = :taskName "
+    logger.debug(f"SQL: {sql}")
+    cursor = dbConn.cursor()
+    try:
+        cursor.execute(sql, theVals)
+    except Exception as err:
+        logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+        sys.exit()
+
+    rows = cursor.fetchall()
+    logger.info(f"running rows fetched: {len(rows)}")
+    return rows
+
+
+def _rptHoursRollup(dbConn, startDateUTC, endDateUTC, rollup, taskName=None, live=False):
+    """Query hours worked per local day rolled up to project or tag
+
+    One query using task_closure, no per task reports.
+
+    Args:
+      dbConn: database connection obj
+      startDateUTC: datetime obj in UTC time. This is the start time
+      endDateUTC: datetime obj in UTC time. This is the end date(inclusive).
+      rollup: 'project' or 'tag' (see rptHours)
+      taskName: name of the project (case insensitve)
+      live: True - running intervals with hours worked up to now
+            False - ended intervals
+
+    Returns:
+      list(trackDateLocal, projectOrTagName, hours_Worked, projectDesc)
+    """
+    theVals = {'taskName': taskName,
+               'startDateUTC': startDateUTC,
+               'endDateUTC': endDateUTC,
+               'nowUTC': datetime.datetime.now(datetime.timezone.utc)}
+    logger.debug(f"theVals: {theVals}")
+    rollupSQL = _ROLLUP_SQL[rollup]
+    if live:
+        fromSQL = """FROM (SELECT track.task_id, track.started,
+    (julianday(:nowUTC) - julianday(track.started)) * 24 AS hours_worked
+    FROM tracking AS track WHERE track.ended = '' OR track.ended IS NULL) AS wrk """
+    else:
+        fromSQL = "FROM v_hours_wrked_detail AS wrk "
+    selectSQL = f"""SELECT strftime("%Y-%m-%d", datetime(strftime("%s", wrk.started), 'unixepoch', 'localtime')) as trackDateLocal,
+    grp.name as grp_name, sum(wrk.hours_worked) as hours_worked, {rollupSQL['desc']} as grp_desc """
+    whereSQL = "WHERE wrk.started between date(:startDateUTC) and date(:endDateUTC,'+1 day') "
+    if taskName:
+        whereSQL += rollupSQL['whereTask']
+    else:
+        whereSQL += rollupSQL['where']
+    groupBySQL = "GROUP BY trackDateLocal, grp_name, grp_desc "
+    orderBySQL = "ORDER BY trackDateLocal DESC, grp_name"
+
+    sql = selectSQL + fromSQL + rollupSQL['join'] + whereSQL + groupBySQL + orderBySQL
+    logger.debug(f"SQL: {sql}")
+    cursor = dbConn.cursor()
+    try:
+        cursor.execute(sql, theVals)
+    except Exception as err:
+        logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+        sys.exit()
+
+    rows = cursor.fetchall()
+    logger.info(f"rollup rows fetched: {len(rows)}")
+    return rows
+
+
+def _mergeRptRows(rows, moreRows):
+    """Add the hours of moreRows into rows, matching on date, task and desc
+
+    Returns:
+      list(trackDateLocal, taskName, hours_Worked, taskDesc) newest date first
+    """
+    merged = {}
+    for rptDate, name, hours, desc in list(rows) + list(moreRows):
+        key = (rptDate, name, desc)
+        merged[key] = merged.get(key, 0) + hours
+    mergedRows = [(key[0], key[1], hours, key[2])
+                  for key, hours in merged.items()]
+    mergedRows.sort(key=lambda row: row[0], reverse=True)
+    return mergedRows
+
+
+def _rptHoursDaily(dbConn, startDateUTC, endDateUTC, taskName=None):
+    """Query hours worked per local day for rptHours (no caching)
+
+    Args:
+      dbConn: database connection obj
+      startDateUTC: datetime obj in UTC time. This is the start time
+      endDateUTC: datetime obj in UTC time. This is the end date(inclusive).
+      taskName: name of the task looking for. (case insensitve)
+
+    Returns:
+      list(trackDateLocal, taskName, hours_Worked, taskDesc)
+    """
 
     logger.info(
         f"Getting hours worked from {startDateUTC.isoformat()} to {endDateUTC.isoformat()}")
@@ -344,7 +890,7 @@ def rptHours(dbConn, startDateUTC, endDateUTC, taskName=None):
                'startDateUTC': startDateUTC,
                'endDateUTC': endDateUTC}
     logger.debug(f"theVals: {theVals}")
-    selectSQL = """Select strftime("%Y-%m-%d", datetime(strftime("%s", started), 'unixepoch', 'localtime')) as trackDateLocal, task_name, sum(hours_worked) as hours_worked, task.desc as task_desc FROM v_hours_wrked_detail as vWrkDetail JOIN task on task.id = task_id """
+    selectSQL = """Select strftime("%Y-%m-%d", datetime(strftime("%s", started), 'unixepoch', 'localtime')) as trackDateLocal, task_name, sum(hours_worked) as hours_worked, task_desc FROM v_hours_wrked_detail as vWrkDetail """
     groupBySQL = "GROUP BY trackDateLocal, task_name, task_desc "
     orderBySQL = "ORDER BY strftime('%Y-%m-%d',started) DESC "
     whereSQL = "WHERE started between date(:startDateUTC) and date(:endDateUTC,'+1 day')"
@@ -365,6 +911,115 @@ def rptHours(dbConn, startDateUTC, endDateUTC, taskName=None):
     return rows
 
 
+def _getWriteSeq(dbConn):
+    """Return the last change_log seq. Changes whenever task or tracking change."""
+    sql = "SELECT seq FROM sqlite_sequence WHERE name = 'change_log'"
+    row = dbConn.cursor().execute(sql).fetchone()
+    return row[0] if row else 0
+
+
+def _rptCacheGet(dbConn, cacheKey, writeSeq):
+    """Get a report result from rpt_cache
+
+    Args:
+      dbConn   : database connection obj
+      cacheKey : str cache key
+      writeSeq : current change_log seq. Entries stored at another seq are stale
+
+    Returns:
+      list of report rows, None if not cached or out of date
+    """
+    sql = """SELECT write_seq, rows,
+    last_used < strftime('%Y-%m-%d %H:%M:%f+00:00', 'now', :touchAge)
+    FROM rpt_cache WHERE cache_key = :cacheKey"""
+    touchSQL = """UPDATE rpt_cache SET hits = hits + 1,
+    last_used = strftime('%Y-%m-%d %H:%M:%f+00:00', 'now') WHERE cache_key = ?"""
+    theVals = {'cacheKey': cacheKey, 'touchAge': f"-{RPT_CACHE_TOUCH_HOURS} hours"}
+    logger.debug(f"SQL: {sql}")
+    logger.debug(f"theVals: {theVals}")
+    try:
+        cursor = dbConn.cursor()
+        cursor.execute(sql, theVals)
+        row = cursor.fetchone()
+        if row and row[0] == writeSeq:
+            _rptCacheStats['hits'] += 1
+            # hits only counts the hits that updated last_used, all hits are logged
+            if row[2]:
+                _rptCacheWrite(dbConn, lambda cursor: cursor.execute(touchSQL, (cacheKey,)))
+            logger.info(
+                f"Report cache hit. hits: {_rptCacheStats['hits']} misses: {_rptCacheStats['misses']}")
+            return [tuple(r) for r in json.loads(row[1])]
+    except Exception as err:
+        logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+        sys.exit()
+
+    _rptCacheStats['misses'] += 1
+    logger.info(
+        f"Report cache miss ({'stale' if row else 'not cached'}) hits: {_rptCacheStats['hits']} misses: {_rptCacheStats['misses']}")
+    return None
+
+
+def _rptCachePut(dbConn, cacheKey, writeSeq, rows):
+    """Store a report result in rpt_cache and evict old entries
+
+    Entries not used for RPT_CACHE_MAX_AGE_DAYS are removed, then only the
+    RPT_CACHE_MAX_ENTRIES most recently used are kept.
+
+    Args:
+      dbConn   : database connection obj
+      cacheKey : str cache key
+      writeSeq : change_log seq read before the report was run
+      rows     : list of report rows
+    """
+    theVals = {'cacheKey': cacheKey, 'writeSeq': writeSeq,
+               'rows': json.dumps(rows), 'maxAge': f"-{RPT_CACHE_MAX_AGE_DAYS} days",
+               'maxEntries': RPT_CACHE_MAX_ENTRIES}
+    putSQL = """INSERT OR REPLACE INTO rpt_cache (cache_key, write_seq, rows)
+    VALUES (:cacheKey, :writeSeq, :rows)"""
+    ageSQL = "DELETE FROM rpt_cache WHERE last_used < strftime('%Y-%m-%d %H:%M:%f+00:00', 'now', :maxAge)"
+    sizeSQL = """DELETE FROM rpt_cache WHERE cache_key NOT IN (
+    SELECT cache_key FROM rpt_cache ORDER BY last_used DESC LIMIT :maxEntries)"""
+    logger.debug(f"SQL: {putSQL}")
+
+    def putTxn(cursor):
+        cursor.execute(putSQL, theVals)
+        evicted = cursor.execute(ageSQL, theVals).rowcount
+        evicted += cursor.execute(sizeSQL, theVals).rowcount
+        return evicted
+
+    evicted = _rptCacheWrite(dbConn, putTxn)
+    if evicted is not None:
+        logger.info(f"Report cached. entries evicted: {evicted}")
+
+
+def _rptCacheWrite(dbConn, txnFunc):
+    """Run a rpt_cache write transaction. A busy database skips the cache write.
+
+    The cache is best effort, so a report never waits on another writer:
+    the busy timeout is cut to RPT_CACHE_BUSY_TIMEOUT for the write and it
+    is not retried.
+
+    Returns:
+      what txnFunc returns, None if the database was busy
+    """
+    cursor = dbConn.cursor()
+    busyTimeout = cursor.execute("PRAGMA busy_timeout").fetchone()[0]
+    cursor.execute(f"PRAGMA busy_timeout = {int(RPT_CACHE_BUSY_TIMEOUT * 1000)}")
+    try:
+        return _writeTxn(dbConn, txnFunc, retries=0)
+    except sqlite3.OperationalError as err:
+        if "locked" not in str(err) and "busy" not in str(err):
+            logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+            sys.exit()
+        logger.info(f"Report cache not updated. Database busy: {err}")
+    except Exception as err:
+        logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+        sys.exit()
+    finally:
+        cursor.execute(f"PRAGMA busy_timeout = {busyTimeout}")
+    return None
+
+
 def purgeDetail(dbConn, daysOld, taskID=None):
     """Delete work detail record from database that are daysOld
 
@@ -390,11 +1045,9 @@ def purgeDetail(dbConn, daysOld, taskID=None):
     sql = "DELETE FROM tracking " + whereSQL
     logger.debug(f"SQL: {sql}")
     logger.debug(f"theVals: {theVals}")
-    cursor = dbConn.cursor()
     try:
-        cursor.execute(sql, theVals)
-        rowsDeleted = cursor.rowcount
-        dbConn.commit()
+        rowsDeleted = _writeTxn(
+            dbConn, lambda cursor: cursor.execute(sql, theVals).rowcount)
     except Exception as err:
         logger.critical(f"Unexpected Error:  {err}", exc_info=True)
         sys.exit()
@@ -403,5 +1056,476 @@ def purgeDetail(dbConn, daysOld, taskID=None):
     return rowsDeleted
 
 
+def checkTracking(dbConn, repair=False, batchSize=5000):
+    """Sweep the tracking table in started order looking for bad intervals
+
+    The table is read in batches of batchSize rows (keyset on started) so
+    memory use stays bounded no matter how many rows there are. Only the
+    interval with the latest end seen so far is kept between rows.
+
+    Issues reported:
+      orphan            : tracking row with no matching task
+      bad_started       : started is not a valid time (or not text)
+      negative_duration : ended is before started (or not a valid time)
+      multiple_open     : open interval followed by another open interval
+      overlap           : interval still running when the next one started
+
+    An ended of NULL or '' is an open interval.
+
+    Args:
+      dbConn    : database connection obj
+      repair    : True - fix each issue as it is found.
+                  orphan rows are deleted, negative durations are set to
+                  zero length and overlapping intervals are ended at the
+                  started time of the next interval. bad_started rows
+                  are left for a manual fix.
+      batchSize : number of tracking rows read per batch
+
+    Yields:
+      tuple(issue, trackID, taskID, started, ended, otherTrackID)
+      otherTrackID is the later interval for overlap/multiple_open issues.
+    """
+    logger.info(f"Checking tracking intervals repair={repair}")
+    selectSQL = """SELECT track.id, track.task_id, task.id, track.started, track.ended,
+    julianday(track.started), julianday(track.ended), typeof(track.started) = 'text'
+    FROM tracking AS track
+    LEFT JOIN task ON task.id = track.task_id
+    WHERE track.started > :lastStarted
+    ORDER BY track.started
+    LIMIT :batchSize"""
+    logger.debug(f"SQL: {selectSQL}")
+    # Numbers sort before text, so the sweep starts below every number
+    theVals = {'lastStarted': -sys.float_info.max, 'batchSize': batchSize}
+    # prev is the interval with the latest end so far
+    # (trackID, taskID, started, ended, endJulian) endJulian None = open
+    prev = None
+    issues = 0
+    cursor = dbConn.cursor()
+    while True:
+        try:
+            cursor.execute(selectSQL, theVals)
+            rows = cursor.fetchall()
+        except Exception as err:
+            logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+            sys.exit()
+        if not rows:
+            break
+
+        repairs = []
+        for trackID, taskID, foundTaskID, started, ended, startJul, endJul, isText in rows:
+            if foundTaskID is None:
+                issues += 1
+                yield ('orphan', trackID, taskID, started, ended, None)
+                if repair:
+                    repairs.append(("DELETE FROM tracking WHERE id = ?",
+                                    (trackID,)))
+                continue
+
+            if startJul is None or not isText:
+                # Can not be placed in time, so it is left out of the overlap checks
+                issues += 1
+                yield ('bad_started', trackID, taskID, started, ended, None)
+                continue
+
+            isOpen = ended is None or ended == ''
+            if not isOpen and (endJul is None or endJul < startJul):
+                issues += 1
+                yield ('negative_duration', trackID, taskID, started, ended, None)
+                if repair:
+                    repairs.append(("UPDATE tracking SET ended = started WHERE id = ?",
+                                    (trackID,)))
+                    ended = started
+                endJul = startJul
+
+            if prev and (prev[4] is None or prev[4] > startJul):
+                issues += 1
+                if prev[4] is None and isOpen:
+                    issue = 'multiple_open'
+                else:
+                    issue = 'overlap'
+                yield (issue, prev[0], prev[1], prev[2], prev[3], trackID)
+                if repair:
+                    repairs.append(("UPDATE tracking SET ended = ? WHERE id = ?",
+                                    (started, prev[0])))
+                    prev = None
+
+            if (prev is None or isOpen
+                    or (prev[4] is not None and endJul >= prev[4])):
+                prev = (trackID, taskID, started, ended,
+                        None if isOpen else endJul)
+
+        if repairs:
+            _repairTracks(dbConn, repairs)
+        theVals['lastStarted'] = rows[-1][3]
+
+    logger.info(f"Tracking check complete. issues found: {issues}")
+
+
+def _repairTracks(dbConn, repairs):
+    """Executes tracking repair statements in one write transaction.
+
+    Args:
+      dbConn  : database connection obj
+      repairs : list of (sql, theVals) repair statements
+    """
+    def repairTxn(cursor):
+        for sql, theVals in repairs:
+            logger.info(f"Repair SQL: {sql} theVals: {theVals}")
+            cursor.execute(sql, theVals)
+
+    try:
+        _writeTxn(dbConn, repairTxn)
+    except Exception as err:
+        logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+        sys.exit()
+
+
+@contextlib.contextmanager
+def _journalLock(journalFile):
+    """Hold an exclusive lock on journalFile.lock
+
+    Taken by appendJournal and for the whole of compactJournal, so an event
+    can not be appended to a journal that is being replayed or removed.
+    The lock file is left in place.
+    """
+    with open(journalFile + ".lock", 'a') as lockFile:
+        if fcntl:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+        else:
+            lockFile.seek(0)
+            while True:
+                try:  # LK_LOCK gives up after 10 attempts a second apart
+                    msvcrt.locking(lockFile.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    logger.info(f"Waiting for journal lock {journalFile}.lock")
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+            else:
+                lockFile.seek(0)
+                msvcrt.locking(lockFile.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def appendJournal(journalFile, event, timeValue, taskID=None):
+    """Append a tracking event to the journal file
+
+    A single line is written and fsync'd under the journal lock. No
+    database work is done, the event is applied to the tracking table by
+    compactJournal.
+    Line format: event|timeValue|taskID
+
+    Args:
+      journalFile : journal file name
+      event       : 'T' end tracking on active task(s) and start taskID
+                    'E' end tracking on active task(s)
+      timeValue   : The UTC time value of the event
+      taskID      : Unique ID for the task to start tracking ('T' only)
+
+    Returns:
+      True
+    """
+    if event not in ('T', 'E'):
+        raise ValueError(f"event must be 'T' or 'E' not '{event}'")
+    line = f"{event}|{timeValue}|{taskID if taskID else ''}\n"
+    logger.info(f"Journal {journalFile} append: {line.strip()}")
+    try:
+        with _journalLock(journalFile), open(journalFile, 'a') as jFile:
+            jFile.write(line)
+            jFile.flush()
+            os.fsync(jFile.fileno())
+    except Exception as err:
+        logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+        sys.exit()
+
+    return True
+
+
+def compactJournal(dbConn, journalFile):
+    """Replay journal events into the tracking table in one transaction
+
+    The journal lock is held from reading the journal until it is removed,
+    so appends wait for the compaction and concurrent compactions run one
+    after the other. Track events are put in their place in
+    time (see _replayTrack), so events older than tracking already in the
+    table do not leave intervals open. Replaying events already applied is
+    safe, they are skipped, so a journal left behind by a failed run is
+    replayed by the next one.
+
+    Args:
+      dbConn      : database connection obj
+      journalFile : journal file name
+
+    Returns:
+      integer of events applied
+    """
+    if not os.path.exists(journalFile):
+        return 0
+
+    endSQL = """UPDATE tracking SET ended = :timeValue
+    WHERE (ended = '' OR ended IS NULL) AND julianday(started) < julianday(:timeValue)"""
+    logger.debug(f"SQL: {endSQL}")
+
+    def replayTxn(cursor):
+        events = 0
+        if not os.path.exists(journalFile):  # compacted while waiting for the lock
+            return events
+        with open(journalFile, 'r') as jFile:
+            for line in jFile:
+                if not line.endswith("\n"):  # partial write at the tail
+                    logger.info(f"Skipping partial journal line: {line}")
+                    continue
+                try:
+                    event, timeValue, taskID = line.rstrip("\n").split("|")
+                    datetime.datetime.fromisoformat(timeValue)
+                    if event == 'T':
+                        taskID = int(taskID)
+                    elif event != 'E':
+                        raise ValueError(f"unknown event {event}")
+                except ValueError:
+                    logger.info(f"Skipping bad journal line: {line.strip()}")
+                    continue
+                if event == 'T':
+                    _replayTrack(cursor, taskID, timeValue)
+                else:
+                    theVals = {'timeValue': timeValue}
+                    logger.debug(f"theVals: {theVals}")
+                    cursor.execute(endSQL, theVals)
+                events += 1
+        return events
+
+    try:
+        with _journalLock(journalFile):
+            logger.info(f"Compacting journal {journalFile}")
+            events = _writeTxn(dbConn, replayTxn)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(journalFile)
+    except Exception as err:
+        logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+        sys.exit()
+
+    logger.info(f"journal events applied: {events}")
+    return events
+
+
+def _replayTrack(cursor, taskID, timeValue):
+    """Apply a journal 'T' event. Called inside the replay transaction.
+
+    The event is put in its place in time, it may be older than tracking
+    already in the table (journal appends and direct tracks race). The
+    interval running at timeValue is ended there and taskID is tracked
+    from timeValue until the next later start, or left open if there is
+    none. A started time already used by another task moves the start a
+    millisecond later, as switchTask does. An event already applied
+    (taskID started at that time) is skipped.
+
+    Args:
+      cursor    : cursor in the replay transaction
+      taskID    : Unique ID for the task to start tracking
+      timeValue : str UTC time of the event
+
+    Returns:
+      True/False (False already applied or taskID not found)
+    """
+    taskSQL = "SELECT id FROM task WHERE id = ?"
+    usedSQL = "SELECT task_id FROM tracking WHERE started = ?"
+    nextSQL = "SELECT min(started) FROM tracking WHERE started > ?"
+    runningSQL = """UPDATE tracking SET ended = :timeValue
+    WHERE id = (SELECT id FROM tracking WHERE started < :timeValue ORDER BY started DESC LIMIT 1)
+    AND (ended = '' OR ended IS NULL OR julianday(ended) > julianday(:timeValue))"""
+    openSQL = """UPDATE tracking SET ended = :timeValue
+    WHERE (ended = '' OR ended IS NULL) AND started < :timeValue"""
+    insertSQL = "INSERT into tracking (task_id, started, ended) VALUES(?,?,?)"
+
+    if cursor.execute(taskSQL, (taskID,)).fetchone() is None:
+        logger.info(f"Skipping journal track of taskID {taskID}, task not found")
+        return False
+    startTime = timeValue
+    while True:
+        row = cursor.execute(usedSQL, (startTime,)).fetchone()
+        if row is None:
+            break
+        if row[0] == taskID:
+            logger.debug(f"journal track taskID {taskID} at {startTime} already applied")
+            return False
+        startTime = str(datetime.datetime.fromisoformat(startTime) + datetime.timedelta(milliseconds=1))
+        logger.info(f"journal start moved to {startTime}, started time used by taskID {row[0]}")
+
+    nextStart = cursor.execute(nextSQL, (startTime,)).fetchone()[0]
+    theVals = {'timeValue': startTime}
+    logger.debug(f"SQL: {runningSQL}")
+    logger.debug(f"SQL: {openSQL}")
+    logger.debug(f"theVals: {theVals}")
+    cursor.execute(runningSQL, theVals)
+    cursor.execute(openSQL, theVals)
+    logger.debug(f"SQL: {insertSQL}")
+    cursor.execute(insertSQL, (taskID, startTime, nextStart))
+    if nextStart:
+        logger.info(f"journal track taskID {taskID} at {startTime} ended at the later start {nextStart}")
+    return True
+
+
+def getChanges(dbConn, sinceSeq=0, batchSize=1000):
+    """Get changes made to task and tracking after sinceSeq
+
+    Changes are read from change_log in batches of batchSize so a large
+    feed is streamed rather than loaded at once.
+
+    Args:
+      dbConn    : database connection obj
+      sinceSeq  : watermark. Only changes with seq greater than this are returned
+      batchSize : number of change_log rows read per batch
+
+    Yields:
+      dict(seq, table, op, id, changed, data)
+      data is the row after insert/update or before delete.
+    """
+    logger.info(f"Getting changes since seq {sinceSeq}")
+    sql = """SELECT seq, tbl, op, row_id, changed, data FROM change_log
+    WHERE seq > :sinceSeq ORDER BY seq LIMIT :batchSize"""
+    logger.debug(f"SQL: {sql}")
+    theVals = {'sinceSeq': sinceSeq, 'batchSize': batchSize}
+    changeCount = 0
+    cursor = dbConn.cursor()
+    while True:
+        try:
+            cursor.execute(sql, theVals)
+            rows = cursor.fetchall()
+        except Exception as err:
+            logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+            sys.exit()
+        if not rows:
+            break
+        for seq, tbl, op, rowID, changed, data in rows:
+            changeCount += 1
+            yield {'seq': seq, 'table': tbl, 'op': op, 'id': rowID,
+                   'changed': changed, 'data': json.loads(data)}
+        theVals['sinceSeq'] = rows[-1][0]
+
+    logger.info(f"changes fetched: {changeCount}")
+
+
+def pruneChanges(dbConn, uptoSeq):
+    """Delete change_log rows up to and including uptoSeq
+
+    Once a consumer has stored its watermark the changes before it are not
+    needed. seq values are never reused after a prune (AUTOINCREMENT).
+
+    Args:
+      dbConn  : database connection obj
+      uptoSeq : consumed watermark. Changes with seq up to this are deleted
+
+    Returns:
+      integer of changes deleted
+    """
+    logger.info(f"Pruning changes up to seq {uptoSeq}")
+    sql = "DELETE FROM change_log WHERE seq <= ?"
+    logger.debug(f"SQL: {sql}")
+    try:
+        rowsDeleted = _writeTxn(
+            dbConn, lambda cursor: cursor.execute(sql, (uptoSeq,)).rowcount)
+    except Exception as err:
+        logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+        sys.exit()
+
+    logger.info(f"changes deleted: {rowsDeleted}")
+    return rowsDeleted
+
+
+def backupDB(dbConn, backupFile, pagesPerStep=100, sleepSecs=0.05, compress=False, verify=True):
+    """Online backup of the database to backupFile
+
+    Uses the sqlite online backup API. pagesPerStep pages are copied at a
+    time, sleeping sleepSecs between steps so other connections can keep
+    writing while the backup runs. The sqlite backup only sleeps itself when
+    a step finds the database busy, so the sleep is done in the progress
+    callback.
+
+    Args:
+      dbConn       : database connection obj
+      backupFile   : path of the backup file to create
+      pagesPerStep : pages copied per backup step (-1 all at once)
+      sleepSecs    : seconds to sleep between backup steps
+      compress     : True - gzip the backup. '.gz' is added to backupFile
+      verify       : True - run an integrity check on the backup
+
+    Returns:
+      str path of the backup file, None if verify failed
+    """
+    logger.info(
+        f"Backup to {backupFile} pagesPerStep={pagesPerStep} sleepSecs={sleepSecs} compress={compress}")
+    if compress:
+        copyFile = backupFile + ".tmp"
+    else:
+        copyFile = backupFile
+
+    def progress(status, remaining, total):
+        logger.debug(f"backup pages copied {total - remaining} of {total}")
+        if remaining > 0 and sleepSecs > 0:
+            time.sleep(sleepSecs)
+
+    try:
+        backupConn = sqlite3.connect(copyFile)
+        with backupConn:
+            dbConn.backup(backupConn, pages=pagesPerStep,
+                          progress=progress, sleep=sleepSecs)
+        backupConn.close()
+    except Exception as err:
+        logger.critical(f"Unexpected Error:  {err}", exc_info=True)
+        sys.exit()
+
+    if compress:
+        backupFile = backupFile + ".gz"
+        logger.info(f"Compressing backup to {backupFile}")
+        with open(copyFile, 'rb') as inFile, gzip.open(backupFile, 'wb') as outFile:
+            shutil.copyfileobj(inFile, outFile)
+        os.remove(copyFile)
+
+    if verify and not verifyBackup(backupFile):
+        return None
+
+    logger.info(f"Backup complete: {backupFile}")
+    return backupFile
+
+
+def verifyBackup(backupFile):
+    """Run an integrity check on a backup file
+
+    Args:
+      backupFile : backup file to check. Files ending in '.gz' are
+                   decompressed to a temp file first.
+
+    Returns:
+      True/False (True integrity check ok)
+    """
+    logger.info(f"Verifying backup {backupFile}")
+    tempName = None
+    checkFile = backupFile
+    if backupFile.endswith(".gz"):
+        fd, tempName = tempfile.mkstemp(suffix=".db")
+        with os.fdopen(fd, 'wb') as outFile, gzip.open(backupFile, 'rb') as inFile:
+            shutil.copyfileobj(inFile, outFile)
+        checkFile = tempName
+
+    try:
+        checkConn = sqlite3.connect(checkFile)
+        rows = checkConn.execute("PRAGMA integrity_check").fetchall()
+        checkConn.close()
+    except sqlite3.DatabaseError as err:
+        logger.info(f"Backup not a valid database: {err}")
+        rows = [(str(err),)]
+    finally:
+        if tempName:
+            os.remove(tempName)
+
+    if rows == [('ok',)]:
+        logger.info("Backup integrity check ok")
+        return True
+    logger.info(f"Backup integrity check failed: {rows}")
+    return False
+
+
 if __name__ == '__main__':
     pass
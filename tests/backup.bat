@@ -0,0 +1,13 @@
+@echo off
+set myBaseDir=%~dp0
+set app=..\tasktracker.bat
+echo ====================================
+echo Backup testing - Required test db.
+echo ====================================
+
+echo TEST - backup database compressed
+set tstOptions=backup -z
+echo ^> %app% %tstOptions%
+call %app% %tstOptions%
+cd %myBaseDir%
+echo ----
\ No newline at end of file
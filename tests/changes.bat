@@ -0,0 +1,13 @@
+@echo off
+set myBaseDir=%~dp0
+set app=..\tasktracker.bat
+echo ====================================
+echo Changes testing - Required test db.
+echo ====================================
+
+echo TEST - changes since 0 to a file
+set tstOptions=changes --since 0 -o ..\data\changes.jsonl
+echo ^> %app% %tstOptions%
+call %app% %tstOptions%
+cd %myBaseDir%
+echo ----
\ No newline at end of file
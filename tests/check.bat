@@ -0,0 +1,13 @@
+@echo off
+set myBaseDir=%~dp0
+set app=..\tasktracker.bat
+echo ====================================
+echo Check testing - Required test db.
+echo ====================================
+
+echo TEST - check tracking
+set tstOptions=check
+echo ^> %app% %tstOptions%
+call %app% %tstOptions%
+cd %myBaseDir%
+echo ----
\ No newline at end of file
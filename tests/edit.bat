@@ -19,3 +19,10 @@ echo ^> %app% %tstOptions%
 call %app% %tstOptions%
 cd %myBaseDir%
 echo ----
+
+echo TEST - Edit existing task parent project
+set tstOptions=edit Task002 -p EditTask001
+echo ^> %app% %tstOptions%
+call %app% %tstOptions%
+cd %myBaseDir%
+echo ----
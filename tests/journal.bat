@@ -0,0 +1,20 @@
+@echo off
+set myBaseDir=%~dp0
+set app=..\tasktracker.bat
+echo ====================================
+echo Journal testing - Required test db.
+echo ====================================
+
+echo TEST - journal track
+set tstOptions=-j track Task002
+echo ^> %app% %tstOptions%
+call %app% %tstOptions%
+cd %myBaseDir%
+echo ----
+
+echo TEST - compact journal
+set tstOptions=compact
+echo ^> %app% %tstOptions%
+call %app% %tstOptions%
+cd %myBaseDir%
+echo ----
\ No newline at end of file
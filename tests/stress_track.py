@@ -0,0 +1,88 @@
+"""Concurrent track stress test
+
+Starts many processes that each switch tracking between tasks as fast as
+they can against the same database. Afterwards every switch must be in
+the tracking table exactly once, with a single open interval and no
+overlaps. Reports the switch throughput.
+
+python tests/stress_track.py [-p processes] [-n switches] [-d dbfile]
+"""
+from pathlib import Path
+from datetime import datetime, timezone
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from tasktracker import taskdb  # noqa: E402
+
+TASKS = ["Stress001", "Stress002", "Stress003"]
+
+
+def worker(dbFile, workerNum, switches, startEvent):
+    """Switch tracking between TASKS switches times"""
+    dbConn = taskdb.create_connection(dbFile)
+    taskIDs = [taskdb.getTaskID(dbConn, name)[0] for name in TASKS]
+    startEvent.wait()
+    for i in range(switches):
+        taskID = taskIDs[(workerNum + i) % len(taskIDs)]
+        taskdb.switchTask(dbConn, taskID, datetime.now(timezone.utc))
+    dbConn.close()
+
+
+def main(processes, switches, dbFile):
+    dbConn = taskdb.create_connection(dbFile)
+    for name in TASKS:
+        taskdb.addTask(dbConn, name)
+    startRows = dbConn.execute("SELECT count(*) FROM tracking").fetchone()[0]
+
+    startEvent = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=worker, args=(dbFile, num, switches, startEvent))
+               for num in range(processes)]
+    for proc in workers:
+        proc.start()
+    time.sleep(1)  # let the workers connect
+    startTime = time.perf_counter()
+    startEvent.set()
+    for proc in workers:
+        proc.join()
+    elapsed = time.perf_counter() - startTime
+
+    failed = [proc.exitcode for proc in workers if proc.exitcode != 0]
+    expected = startRows + processes * switches
+    rows = dbConn.execute("SELECT count(*) FROM tracking").fetchone()[0]
+    openRows = len(taskdb.getActiveTask(dbConn))
+    issues = list(taskdb.checkTracking(dbConn))
+
+    print(f"processes: {processes} switches each: {switches}")
+    print(f"elapsed: {elapsed:.2f}s throughput: {processes * switches / elapsed:.1f} switches/s")
+    print(f"tracking rows: {rows} expected: {expected}")
+    print(f"open intervals: {openRows}")
+    print(f"tracking issues: {len(issues)}")
+    for issue in issues[:10]:
+        print(f"\t{issue}")
+
+    if failed or rows != expected or openRows != 1 or issues:
+        print("FAILED")
+        return 1
+    print("PASSED")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Concurrent track stress test")
+    parser.add_argument('-p', '--processes', help='Number of processes (default 8)',
+                        type=int, default=8, dest='processes')
+    parser.add_argument('-n', '--switches', help='Switches per process (default 50)',
+                        type=int, default=50, dest='switches')
+    parser.add_argument('-d', '--dbfile', help='Database file (default a new temp file)',
+                        type=str, dest='dbFile')
+    args = parser.parse_args()
+
+    dbFile = args.dbFile
+    if not dbFile:
+        dbFile = os.path.join(tempfile.mkdtemp(), "stress.db")
+    sys.exit(main(args.processes, args.switches, dbFile))
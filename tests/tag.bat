@@ -0,0 +1,19 @@
+@echo off
+set myBaseDir=%~dp0
+set app=..\tasktracker.bat
+echo ====================================
+echo Tag testing - Required test db.
+echo ====================================
+
+echo TEST - tag a task
+set tstOptions=tag Task001 billable
+echo ^> %app% %tstOptions%
+call %app% %tstOptions%
+cd %myBaseDir%
+echo ----
+echo TEST - report hours rolled up to tags
+set tstOptions=report 2000-01-01 -r tag
+echo ^> %app% %tstOptions%
+call %app% %tstOptions%
+cd %myBaseDir%
+echo ----
\ No newline at end of file
@@ -0,0 +1,138 @@
+"""checkTracking issue and repair tests
+
+Each kind of bad interval is seeded into a fresh database. The issues
+yielded by checkTracking and the tracking rows left after a repair are
+checked.
+
+python -m unittest tests.test_checktracking
+"""
+from pathlib import Path
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from tasktracker import taskdb  # noqa: E402
+
+
+def utc(hour, minute=0):
+    return f"2024-01-01 {hour:02}:{minute:02}:00+00:00"
+
+
+class CheckTrackingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.dbConn = taskdb.create_connection(os.path.join(self.tempDir, "check.db"))
+        taskdb.addTask(self.dbConn, "TaskA")
+        taskdb.addTask(self.dbConn, "TaskB")
+
+    def tearDown(self):
+        self.dbConn.close()
+        shutil.rmtree(self.tempDir)
+
+    def seed(self, rows):
+        """Insert (id, task_id, started, ended) rows. Foreign keys are off so orphans can be added."""
+        self.dbConn.commit()
+        self.dbConn.execute("PRAGMA foreign_keys = OFF")
+        self.dbConn.executemany(
+            "INSERT into tracking (id, task_id, started, ended) VALUES(?,?,?,?)", rows)
+        self.dbConn.commit()
+        self.dbConn.execute("PRAGMA foreign_keys = ON")
+
+    def issues(self, repair=False, batchSize=2):
+        # A small batchSize so the keyset moves between batches
+        return [issue[:2] + issue[5:] for issue in
+                taskdb.checkTracking(self.dbConn, repair=repair, batchSize=batchSize)]
+
+    def tracking(self):
+        return self.dbConn.execute(
+            "SELECT id, task_id, started, ended FROM tracking ORDER BY id").fetchall()
+
+    def test_clean(self):
+        self.seed([(1, 1, utc(9), utc(10)),
+                   (2, 2, utc(10), utc(11)),
+                   (3, 1, utc(11), None)])
+        self.assertEqual(self.issues(), [])
+
+    def test_orphan(self):
+        self.seed([(1, 1, utc(9), utc(10)),
+                   (2, 99, utc(10), utc(11))])
+        self.assertEqual(self.issues(), [('orphan', 2, None)])
+        self.assertEqual(self.issues(repair=True), [('orphan', 2, None)])
+        self.assertEqual(self.tracking(), [(1, 1, utc(9), utc(10))])
+        self.assertEqual(self.issues(), [])
+
+    def test_negative_duration(self):
+        self.seed([(1, 1, utc(9), utc(8)),
+                   (2, 2, utc(10), 'garbage')])
+        expected = [('negative_duration', 1, None), ('negative_duration', 2, None)]
+        self.assertEqual(self.issues(), expected)
+        self.assertEqual(self.issues(repair=True), expected)
+        self.assertEqual(self.tracking(), [(1, 1, utc(9), utc(9)),
+                                           (2, 2, utc(10), utc(10))])
+        self.assertEqual(self.issues(), [])
+
+    def test_overlap(self):
+        # 2 ends after 3 starts. 1 runs over both.
+        self.seed([(1, 1, utc(9), utc(12)),
+                   (2, 2, utc(10), utc(10, 45)),
+                   (3, 1, utc(10, 30), utc(11))])
+        self.assertEqual(self.issues(), [('overlap', 1, 2), ('overlap', 1, 3)])
+        self.assertEqual(self.issues(repair=True), [('overlap', 1, 2), ('overlap', 2, 3)])
+        self.assertEqual(self.tracking(), [(1, 1, utc(9), utc(10)),
+                                           (2, 2, utc(10), utc(10, 30)),
+                                           (3, 1, utc(10, 30), utc(11))])
+        self.assertEqual(self.issues(), [])
+
+    def test_multiple_open(self):
+        # '' is open, the same as NULL
+        self.seed([(1, 1, utc(9), ''),
+                   (2, 2, utc(10), None)])
+        self.assertEqual(self.issues(), [('multiple_open', 1, 2)])
+        self.assertEqual(self.issues(repair=True), [('multiple_open', 1, 2)])
+        # The running task is left open
+        self.assertEqual(self.tracking(), [(1, 1, utc(9), utc(10)),
+                                           (2, 2, utc(10), None)])
+        self.assertEqual(self.issues(), [])
+
+    def test_running_empty_ended(self):
+        self.seed([(1, 1, utc(9), utc(10)),
+                   (2, 2, utc(10), '')])
+        self.assertEqual(self.issues(repair=True), [])
+        self.assertEqual(self.tracking()[1], (2, 2, utc(10), ''))
+
+    def test_bad_started(self):
+        # Numbers sort before text and are still read
+        self.seed([(1, 1, 1700000000, None),
+                   (2, 2, 'garbage', utc(11)),
+                   (3, 1, utc(9), utc(10))])
+        expected = [('bad_started', 1, None), ('bad_started', 2, None)]
+        self.assertEqual(self.issues(), expected)
+        # Not repaired, left for a manual fix
+        before = self.tracking()
+        self.assertEqual(self.issues(repair=True), expected)
+        self.assertEqual(self.tracking(), before)
+        self.assertTrue(all(issue[0] in taskdb.CHECK_NOT_REPAIRED for issue in self.issues()))
+
+    def test_repair_all(self):
+        self.seed([(1, 1, utc(9), utc(11)),
+                   (2, 99, utc(9, 30), utc(9, 45)),
+                   (3, 2, utc(10), utc(9)),
+                   (4, 1, utc(12), None),
+                   (5, 2, utc(13), None)])
+        self.assertEqual(self.issues(),
+                         [('orphan', 2, None), ('negative_duration', 3, None),
+                          ('overlap', 1, 3), ('multiple_open', 4, 5)])
+        list(taskdb.checkTracking(self.dbConn, repair=True))
+        self.assertEqual(self.issues(), [])
+        self.assertEqual(self.tracking(), [(1, 1, utc(9), utc(10)),
+                                           (3, 2, utc(10), utc(10)),
+                                           (4, 1, utc(12), utc(13)),
+                                           (5, 2, utc(13), None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""Journal replay tests
+
+Events are appended to a journal and compacted into a fresh database,
+including events older than tracking already in the table.
+
+python -m unittest tests.test_journal
+"""
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from tasktracker import taskdb  # noqa: E402
+
+START = datetime(2024, 1, 1, 10, tzinfo=timezone.utc)
+
+
+def hours(num):
+    return START + timedelta(hours=num)
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.dbConn = taskdb.create_connection(os.path.join(self.tempDir, "journal.db"))
+        self.journalFile = os.path.join(self.tempDir, "journal.journal")
+        for name in ("TaskA", "TaskB", "TaskC"):
+            taskdb.addTask(self.dbConn, name)
+
+    def tearDown(self):
+        self.dbConn.close()
+        shutil.rmtree(self.tempDir)
+
+    def tracking(self):
+        return self.dbConn.execute(
+            "SELECT task_id, started, ended FROM tracking ORDER BY started").fetchall()
+
+    def assertClean(self):
+        self.assertEqual(list(taskdb.checkTracking(self.dbConn)), [])
+        self.assertEqual(len(taskdb.getActiveTask(self.dbConn)), 1)
+
+    def test_in_order(self):
+        taskdb.appendJournal(self.journalFile, 'T', hours(0), taskID=1)
+        taskdb.appendJournal(self.journalFile, 'T', hours(1), taskID=2)
+        taskdb.appendJournal(self.journalFile, 'E', hours(2))
+        taskdb.appendJournal(self.journalFile, 'T', hours(3), taskID=3)
+        self.assertEqual(taskdb.compactJournal(self.dbConn, self.journalFile), 4)
+        self.assertFalse(os.path.exists(self.journalFile))
+        self.assertEqual(self.tracking(), [(1, str(hours(0)), str(hours(1))),
+                                           (2, str(hours(1)), str(hours(2))),
+                                           (3, str(hours(3)), None)])
+        self.assertClean()
+
+    def test_older_than_direct_track(self):
+        # A journal track races a direct track that got to the database first
+        taskdb.switchTask(self.dbConn, 1, hours(-2))
+        taskdb.switchTask(self.dbConn, 2, hours(1))
+        taskdb.appendJournal(self.journalFile, 'T', hours(0), taskID=3)
+        taskdb.compactJournal(self.dbConn, self.journalFile)
+        self.assertEqual(self.tracking(), [(1, str(hours(-2)), str(hours(0))),
+                                           (3, str(hours(0)), str(hours(1))),
+                                           (2, str(hours(1)), None)])
+        self.assertClean()
+
+    def test_out_of_order_appends(self):
+        taskdb.appendJournal(self.journalFile, 'T', hours(2), taskID=2)
+        taskdb.appendJournal(self.journalFile, 'T', hours(1), taskID=1)
+        taskdb.compactJournal(self.dbConn, self.journalFile)
+        self.assertEqual(self.tracking(), [(1, str(hours(1)), str(hours(2))),
+                                           (2, str(hours(2)), None)])
+        self.assertClean()
+
+    def test_same_started_time(self):
+        # The second switch is kept, a millisecond later
+        taskdb.switchTask(self.dbConn, 1, hours(0))
+        taskdb.appendJournal(self.journalFile, 'T', hours(0), taskID=2)
+        taskdb.compactJournal(self.dbConn, self.journalFile)
+        moved = hours(0) + timedelta(milliseconds=1)
+        self.assertEqual(self.tracking(), [(1, str(hours(0)), str(moved)),
+                                           (2, str(moved), None)])
+        self.assertClean()
+
+    def test_replay_twice(self):
+        # A journal left behind after the transaction committed is replayed again
+        taskdb.switchTask(self.dbConn, 1, hours(0))
+        for num, taskID in ((0, 2), (1, 3), (-1, 2)):
+            taskdb.appendJournal(self.journalFile, 'T', hours(num), taskID=taskID)
+        with open(self.journalFile) as jFile:
+            journal = jFile.read()
+        taskdb.compactJournal(self.dbConn, self.journalFile)
+        applied = self.tracking()
+        with open(self.journalFile, 'w') as jFile:
+            jFile.write(journal)
+        taskdb.compactJournal(self.dbConn, self.journalFile)
+        self.assertEqual(self.tracking(), applied)
+        self.assertClean()
+
+    def test_unknown_task_skipped(self):
+        taskdb.appendJournal(self.journalFile, 'T', hours(0), taskID=1)
+        taskdb.appendJournal(self.journalFile, 'T', hours(1), taskID=99)
+        taskdb.compactJournal(self.dbConn, self.journalFile)
+        self.assertEqual(self.tracking(), [(1, str(hours(0)), None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
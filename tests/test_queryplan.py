@@ -0,0 +1,215 @@
+"""Query plan guardrails for taskdb SQL
+
+Each hot taskdb call is run against a seeded database with the sql
+traced. Every statement it ran is checked with EXPLAIN QUERY PLAN and the
+test fails if a table is scanned or a temp b-tree is used where an index
+is expected.
+
+python -m unittest tests.test_queryplan
+"""
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from tasktracker import taskdb  # noqa: E402
+
+# Plan details that are a problem unless allowed for the call
+BAD_PLAN = re.compile(r"^SCAN |TEMP B-TREE")
+# Grouping reports by local day always needs temp b-trees
+REPORT_ALLOWED = [r"^USE TEMP B-TREE FOR (GROUP|ORDER) BY$"]
+# Running intervals are read from the partial index, only open rows are scanned
+OPEN_ALLOWED = [r"^SCAN (tracking|track) USING INDEX idx_tracking_open$",
+                r"^USE TEMP B-TREE FOR ORDER BY$"]
+# sqlite_sequence holds one row per AUTOINCREMENT table
+WRITE_SEQ_ALLOWED = [r"^SCAN sqlite_sequence$"]
+# rpt_cache is kept to RPT_CACHE_MAX_ENTRIES rows
+CACHE_ALLOWED = [r"^SCAN rpt_cache$", r"^USE TEMP B-TREE FOR ORDER BY$"]
+# Older plan text, normalized to the SQLite 3.36+ form before matching
+PLAN_TABLE = re.compile(r"^(SCAN|SEARCH) TABLE (?:\S+ AS )?")
+STARTED_RANGE = r"^SEARCH (tracking|track) USING (COVERING )?INDEX \S+ \(started>\? AND started<\?\)$"
+
+TASKS = 200
+TRACKS = 5000
+
+
+class QueryPlanTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tempDir = tempfile.mkdtemp()
+        cls.dbFile = os.path.join(cls.tempDir, "queryplan.db")
+        cls.dbConn = taskdb.create_connection(cls.dbFile)
+        cls.planConn = sqlite3.connect(cls.dbFile)
+        cls.startUTC = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+        # Projects 3 levels deep, a few tags, and closed tracking with one open interval
+        for num in range(1, TASKS + 1):
+            taskdb.addTask(cls.dbConn, f"Task{num:03}", f"Task number {num}")
+            if num > 10:
+                taskdb.setTaskParent(cls.dbConn, num, num // 10)
+            if num % 7 == 0:
+                taskdb.tagTask(cls.dbConn, num, f"Tag{num % 3}")
+        rows = []
+        for num in range(TRACKS):
+            started = cls.startUTC + timedelta(minutes=30 * num)
+            rows.append((num % TASKS + 1, started, started + timedelta(minutes=25)))
+        cls.dbConn.executemany(
+            "INSERT into tracking (task_id, started, ended) VALUES(?,?,?)", rows)
+        cls.dbConn.commit()
+        taskdb.switchTask(cls.dbConn, 1, cls.startUTC + timedelta(minutes=30 * TRACKS))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dbConn.close()
+        cls.planConn.close()
+        shutil.rmtree(cls.tempDir)
+
+    def tracedSql(self, call):
+        """Run call() and return the unique DML statements it executed"""
+        statements = []
+        self.dbConn.set_trace_callback(statements.append)
+        try:
+            call()
+        finally:
+            self.dbConn.set_trace_callback(None)
+        dml = []
+        for sql in statements:
+            if sql.split()[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH') \
+                    and "sqlite_master" not in sql and sql not in dml:
+                dml.append(sql)
+        return dml
+
+    def queryPlan(self, sql):
+        # SQLite before 3.36 prints 'SCAN TABLE tracking AS track', later 'SCAN track'
+        return [PLAN_TABLE.sub(r"\1 ", row[-1])
+                for row in self.planConn.execute("EXPLAIN QUERY PLAN " + sql)]
+
+    def assertPlans(self, call, allowed=(), required=()):
+        """Fail if a statement run by call() scans or sorts outside allowed
+
+        allowed  : regex of plan details accepted for this call
+        required : regex of plan details that must be in one of the plans
+        """
+        statements = self.tracedSql(call)
+        self.assertTrue(statements, "no sql executed")
+        allPlans = []
+        for sql in statements:
+            plan = self.queryPlan(sql)
+            allPlans.extend(plan)
+            for detail in plan:
+                if BAD_PLAN.search(detail) and not any(re.search(ok, detail) for ok in allowed):
+                    self.fail(f"'{detail}' in plan for:\n{sql}\nplan: {plan}")
+        for need in required:
+            self.assertTrue(any(re.search(need, detail) for detail in allPlans),
+                            f"'{need}' not in plans: {allPlans}")
+
+    def test_getTaskID(self):
+        self.assertPlans(lambda: taskdb.getTaskID(self.dbConn, "task010"),
+                         required=[r"^SEARCH task USING (COVERING )?INDEX \S+ \(name=\?\)$"])
+
+    def test_getTasks(self):
+        # The full list is wanted, in name order straight from the name index
+        self.assertPlans(lambda: taskdb.getTasks(self.dbConn),
+                         allowed=[r"^SCAN (?i:task) USING (COVERING )?INDEX \S+$"])
+
+    def test_getActiveTask(self):
+        self.assertPlans(lambda: taskdb.getActiveTask(self.dbConn), allowed=OPEN_ALLOWED,
+                         required=[r"idx_tracking_open"])
+
+    def test_rptHours(self):
+        self.assertPlans(lambda: taskdb.rptHours(self.dbConn, self.startUTC, self.startUTC + timedelta(days=7),
+                                                 useCache=False),
+                         allowed=REPORT_ALLOWED, required=[STARTED_RANGE])
+
+    def test_rptHours_task(self):
+        self.assertPlans(lambda: taskdb.rptHours(self.dbConn, self.startUTC, self.startUTC + timedelta(days=7),
+                                                 taskName="Task010", useCache=False),
+                         allowed=REPORT_ALLOWED)
+
+    def test_rptHours_cached(self):
+        self.assertPlans(lambda: taskdb.rptHours(self.dbConn, self.startUTC, self.startUTC + timedelta(days=7)),
+                         allowed=REPORT_ALLOWED + WRITE_SEQ_ALLOWED + CACHE_ALLOWED,
+                         required=[r"^SEARCH rpt_cache USING INDEX \S+ \(cache_key=\?\)$"])
+
+    def test_rptHours_live(self):
+        self.assertPlans(lambda: taskdb.rptHours(self.dbConn, self.startUTC, self.startUTC + timedelta(days=365),
+                                                 useCache=False, live=True),
+                         allowed=REPORT_ALLOWED + OPEN_ALLOWED,
+                         required=[r"^SEARCH track USING INDEX idx_tracking_open \(started>\? AND started<\?\)$"])
+
+    def test_rptHours_rollup_project(self):
+        self.assertPlans(lambda: taskdb.rptHours(self.dbConn, self.startUTC, self.startUTC + timedelta(days=7),
+                                                 rollup='project', useCache=False, live=True),
+                         allowed=REPORT_ALLOWED + OPEN_ALLOWED,
+                         required=[STARTED_RANGE, r"idx_task_closure_desc"])
+
+    def test_rptHours_rollup_project_task(self):
+        self.assertPlans(lambda: taskdb.rptHours(self.dbConn, self.startUTC, self.startUTC + timedelta(days=7),
+                                                 taskName="Task002", rollup='project', useCache=False),
+                         allowed=REPORT_ALLOWED)
+
+    def test_rptHours_rollup_tag(self):
+        self.assertPlans(lambda: taskdb.rptHours(self.dbConn, self.startUTC, self.startUTC + timedelta(days=7),
+                                                 rollup='tag', useCache=False),
+                         allowed=REPORT_ALLOWED, required=[STARTED_RANGE])
+
+    def test_purgeDetail(self):
+        self.assertPlans(lambda: taskdb.purgeDetail(self.dbConn, 99999))
+
+    def test_purgeDetail_task(self):
+        self.assertPlans(lambda: taskdb.purgeDetail(self.dbConn, 99999, taskID=3))
+
+    def test_checkTracking(self):
+        self.assertPlans(lambda: list(taskdb.checkTracking(self.dbConn, batchSize=1000)),
+                         required=[r"^SEARCH track USING INDEX \S+ \(started>\?\)$"])
+
+    def test_getChanges(self):
+        self.assertPlans(lambda: list(taskdb.getChanges(self.dbConn, 100)),
+                         required=[r"^SEARCH change_log USING INTEGER PRIMARY KEY \(rowid>\?\)$"])
+
+    def test_pruneChanges(self):
+        self.assertPlans(lambda: taskdb.pruneChanges(self.dbConn, 10),
+                         required=[r"^SEARCH change_log USING INTEGER PRIMARY KEY \(rowid<\?\)$"])
+
+    def test_switchTask(self):
+        self.assertPlans(lambda: taskdb.switchTask(self.dbConn, 2, datetime.now(timezone.utc)),
+                         allowed=OPEN_ALLOWED)
+
+    def test_endActiveTasks(self):
+        self.assertPlans(lambda: taskdb.endActiveTasks(self.dbConn, datetime.now(timezone.utc)),
+                         allowed=OPEN_ALLOWED)
+
+    def test_compactJournal(self):
+        # An event older than the latest started is put in its place in time
+        journalFile = os.path.join(self.tempDir, "queryplan.journal")
+        taskdb.appendJournal(journalFile, 'T', self.startUTC + timedelta(minutes=30 * 100 + 5), taskID=4)
+        taskdb.appendJournal(journalFile, 'E', datetime.now(timezone.utc))
+        self.assertPlans(lambda: taskdb.compactJournal(self.dbConn, journalFile), allowed=OPEN_ALLOWED,
+                         required=[r"^SEARCH tracking USING (COVERING )?INDEX \S+ \(started<\?\)$"])
+
+    def test_setTaskParent(self):
+        self.assertPlans(lambda: taskdb.setTaskParent(self.dbConn, 150, 16))
+
+    def test_foreign_keys_indexed(self):
+        """Deleting a parent row looks up child rows by the foreign key columns"""
+        tables = [row[0] for row in self.planConn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        for table in tables:
+            leading = set()
+            for index in self.planConn.execute(f"PRAGMA index_list({table})"):
+                columns = self.planConn.execute(f"PRAGMA index_info({index[1]})").fetchall()
+                leading.add(columns[0][2])
+            for fkey in self.planConn.execute(f"PRAGMA foreign_key_list({table})"):
+                self.assertIn(fkey[3], leading,
+                              f"{table}.{fkey[3]} references {fkey[2]} but has no index")
+
+
+if __name__ == '__main__':
+    unittest.main()